@@ -0,0 +1,122 @@
+import asyncio
+import concurrent.futures
+import json
+
+
+# Runs the clock on an asyncio event loop. All pattern state is only ever touched from the single render thread, so
+# nothing is mutated across threads; the loop itself just keeps time, fetches the weather and serves control commands.
+class AsyncClockRuntime(object):
+    def __init__(self, args, size_data, matrix, containing_dir=None):
+        self.args = args
+        self.size_data = size_data
+        self.matrix = matrix
+        self.containing_dir = containing_dir
+        self.render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+        # Blocking network calls (the NOAA client isn't async) go here, so they never hold up a frame
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='io')
+        self.renderer = None
+        self.stopping = None
+
+    async def run_in_render(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.render_executor, func, *args)
+
+    def _render_step(self):
+        img = self.renderer.render_frame()
+        self.matrix.SetImage(img, 0, 0)
+        return self.renderer.finish_render()
+
+    async def frame_loop(self):
+        loop = asyncio.get_running_loop()
+        next_frame = loop.time()
+        while not self.stopping.is_set():
+            sleep_time = await self.run_in_render(self._render_step)
+            if self.args.debug_single:
+                self.stopping.set()
+                return
+            # Schedule against the loop clock rather than sleeping a relative amount, so timing errors don't add up
+            next_frame = max(next_frame + sleep_time + self.renderer.get_fps_clock().get_last_render_time(),
+                             loop.time())
+            await asyncio.sleep(next_frame - loop.time())
+            await self.run_in_render(self.renderer.finish_frame)
+
+    async def weather_loop(self):
+        check_time = self.renderer.get_weather_pattern().refresh_check_duration.total_seconds()
+        loop = asyncio.get_running_loop()
+        while not self.stopping.is_set():
+            # Looked up every time, since a config reload can replace the pattern
+            weather_pat = await self.run_in_render(self.renderer.get_weather_pattern)
+            if await self.run_in_render(weather_pat.needs_refresh):
+                try:
+                    weather_data = await loop.run_in_executor(
+                        self.io_executor, weather_pat.get_weather_cache().get_current_prediction)
+                except Exception as e:
+                    print('Couldn\'t retrieve weather data: {:s}'.format(str(e)))
+                    weather_data = None
+                await self.run_in_render(weather_pat.update_weather, weather_data)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), check_time)
+            except asyncio.TimeoutError:
+                pass
+
+    async def handle_control(self, reader, writer):
+        try:
+            while not self.stopping.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode('utf-8', errors='replace').split()
+                if len(words) == 0:
+                    continue
+                response = await self.run_command(words[0].lower(), words[1:])
+                writer.write((json.dumps(response) + '\n').encode('utf-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def run_command(self, command, arguments):
+        if command == 'status':
+            return await self.run_in_render(self.renderer.get_status)
+        elif command == 'memory':
+            return await self.run_in_render(self.renderer.get_memory_snapshot)
+        elif command == 'pattern':
+            name = arguments[0] if len(arguments) > 0 else None
+            if name == 'rotate':
+                name = None
+            try:
+                await self.run_in_render(self.renderer.set_pattern_override, name)
+            except ValueError as e:
+                return {'error': str(e)}
+            return {'pattern': name if name is not None else 'rotate'}
+        elif command == 'quit':
+            self.stopping.set()
+            return {'quit': True}
+        return {'error': 'Unknown command {:s}, expected status, memory, pattern NAME|rotate or quit'.format(command)}
+
+    async def run(self):
+        import clock
+        self.stopping = asyncio.Event()
+        # Built on the render thread, since that's the only thread that will touch it from here on
+        self.renderer = await self.run_in_render(
+            lambda: clock.ClockRenderer(self.args, self.size_data, self.matrix, containing_dir=self.containing_dir,
+                                        background_weather=False))
+        tasks = [asyncio.create_task(self.frame_loop()), asyncio.create_task(self.weather_loop())]
+        server = None
+        if self.args.control_port is not None:
+            server = await asyncio.start_server(self.handle_control, self.args.control_host, self.args.control_port)
+            print('Control server listening on {:s}:{:d}'.format(self.args.control_host, self.args.control_port))
+        try:
+            await self.stopping.wait()
+        finally:
+            self.stopping.set()
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.render_executor.shutdown(wait=True)
+            self.io_executor.shutdown(wait=False)
+
+
+async def run(args, size_data, matrix, containing_dir=None):
+    await AsyncClockRuntime(args, size_data, matrix, containing_dir=containing_dir).run()
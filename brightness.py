@@ -0,0 +1,99 @@
+import math
+import fps_tools
+
+# Where dimming happens: the matrix PWM, a LUT over the rendered frame, or coarse hardware steps refined in software
+brightness_modes = ['hardware', 'software', 'both']
+# In 'both' mode the hardware brightness moves in steps of this size, software makes up the rest
+hardware_step = 10
+
+
+def gen_brightness_lut(level, gamma):
+    scale = max(min(level, 100), 0) / 100
+    return [int(round(((val / 255) ** gamma) * scale * 255)) for val in range(256)]
+
+
+class BrightnessLUT(object):
+    def __init__(self, gamma=None):
+        if gamma is None:
+            gamma = 1.0
+        self.gamma = gamma
+        self.level = None
+        self.lut = None
+        self.identity = False
+
+    def get_lut(self, level):
+        level = int(round(level))
+        # Only rebuild the table when the level actually changes, so a frame stays a single pass
+        if level != self.level:
+            self.level = level
+            table = gen_brightness_lut(level, self.gamma)
+            self.identity = table == list(range(256))
+            self.lut = table * 3  # One table per RGB band
+        return self.lut
+
+    def apply(self, image, level):
+        lut = self.get_lut(level)
+        if self.identity:
+            return image
+        return image.point(lut)
+
+
+class BrightnessControl(object):
+    def __init__(self, matrix, mode=None, gamma=None, day_level=None, night_level=None, ramp_time=None):
+        if mode is None:
+            mode = 'hardware'
+        if mode not in brightness_modes:
+            raise ValueError('Brightness mode must be one of {:s}, not {:s}'.format(str(brightness_modes), str(mode)))
+        if day_level is None:
+            day_level = 100
+        if night_level is None:
+            night_level = 10
+        if ramp_time is None:
+            ramp_time = 300  # Seconds to go from day to night brightness
+        self.matrix = matrix
+        self.mode = mode
+        self.day_level = day_level
+        self.night_level = night_level
+        ramp_speed = abs(day_level - night_level) / ramp_time if ramp_time > 0 else math.inf
+        self.level = fps_tools.DTAwareRamp(d_dt=ramp_speed, start_value=day_level)
+        self.lut = BrightnessLUT(gamma=gamma)
+        self.hardware_level = None
+        self.software_level = 100
+        self.started = False
+
+    def set_night(self, is_night):
+        target = self.night_level if is_night else self.day_level
+        if not self.started:
+            # Nothing has been shown yet, so there's nothing to smooth over
+            self.level.set_value(target)
+        else:
+            self.level.set_target(target)
+
+    def dt(self, dt):
+        self.started = True
+        self.level.dt(dt)
+        level = self.level.get_value()
+        if self.mode == 'hardware':
+            hardware_level = int(math.ceil(level))
+            self.software_level = 100
+        elif self.mode == 'software':
+            hardware_level = 100
+            self.software_level = level
+        else:
+            hardware_level = min(100, int(math.ceil(level / hardware_step)) * hardware_step)
+            self.software_level = level / hardware_level * 100 if hardware_level > 0 else 0
+        if hardware_level != self.hardware_level:
+            self.hardware_level = hardware_level
+            self.matrix.brightness = hardware_level
+
+    def apply(self, image):
+        return self.lut.apply(image, self.software_level)
+
+    def get_level(self):
+        return self.level.get_value()
+
+    def get_hardware_level(self):
+        return self.hardware_level
+
+    def get_software_level(self):
+        return self.software_level
@@ -0,0 +1,174 @@
+import os
+import queue
+import threading
+import memory_tools
+
+capture_extensions = ('.rgb', '.y4m', '.gif', '.png', '.apng')
+# Animated formats have to hold every frame of a file until it's written, so once the frames held reach this many
+# bytes they're written out and the capture carries on in a new file; 256 frames at 256x128
+animated_byte_limit = 32 * 1024 * 1024
+
+
+class FrameWriter(object):
+    def __init__(self, path, image_size, fps, decimation):
+        self.path = path
+        self.image_size = image_size
+        self.fps = fps
+        self.decimation = decimation
+
+    def write(self, image):
+        pass
+
+    def close(self):
+        pass
+
+
+class RawFrameWriter(FrameWriter):
+    # Packed 8-bit RGB, one frame after another with no header; the size and rate are printed when capture starts
+    def __init__(self, path, image_size, fps, decimation):
+        super().__init__(path, image_size, fps, decimation)
+        self.outfil = open(path, 'wb')
+
+    def write(self, image):
+        self.outfil.write(image.convert('RGB').tobytes())
+
+    def close(self):
+        self.outfil.close()
+
+
+class Y4MFrameWriter(FrameWriter):
+    def __init__(self, path, image_size, fps, decimation):
+        super().__init__(path, image_size, fps, decimation)
+        self.outfil = open(path, 'wb')
+        # Full resolution chroma, since our frames are mostly thin lines of color; Pillow's YCbCr is full range
+        self.outfil.write('YUV4MPEG2 W{:d} H{:d} F{:d}:{:d} Ip A1:1 C444 XCOLORRANGE=FULL\n'.format(
+            image_size[0], image_size[1], fps, decimation).encode('ascii'))
+
+    def write(self, image):
+        self.outfil.write(b'FRAME\n')
+        for plane in image.convert('RGB').convert('YCbCr').split():
+            self.outfil.write(plane.tobytes())
+
+    def close(self):
+        self.outfil.close()
+
+
+class AnimatedFrameWriter(FrameWriter):
+    def __init__(self, path, image_size, fps, decimation, image_format):
+        super().__init__(path, image_size, fps, decimation)
+        self.image_format = image_format
+        self.frames = []
+        self.frame_bytes = 0
+        # Files written so far; the first goes to the path, the rest to path-2, path-3 and so on
+        self.segments = 0
+        self.frames_flushed = 0
+
+    def get_segment_path(self):
+        if self.segments == 0:
+            return self.path
+        (base, extension) = os.path.splitext(self.path)
+        return '{:s}-{:d}{:s}'.format(base, self.segments + 1, extension)
+
+    def write(self, image):
+        frame = image.convert('RGB')
+        self.frames.append(frame)
+        self.frame_bytes += memory_tools.image_bytes(frame)
+        if self.frame_bytes >= animated_byte_limit:
+            path = self.get_segment_path()
+            self.flush()
+            print('Wrote {:d} frames to {:s}, carrying on in {:s}'.format(
+                self.frames_flushed, path, self.get_segment_path()))
+
+    def flush(self):
+        if len(self.frames) == 0:
+            return
+        path = self.get_segment_path()
+        self.frames[0].save(path, format=self.image_format, save_all=True, append_images=self.frames[1:],
+                            duration=int(round(1000 * self.decimation / self.fps)), loop=0)
+        self.frames_flushed = len(self.frames)
+        self.segments += 1
+        self.frames = []
+        self.frame_bytes = 0
+
+    def close(self):
+        self.flush()
+
+
+def create_writer(path, image_size, fps, decimation):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.rgb':
+        return RawFrameWriter(path, image_size, fps, decimation)
+    elif extension == '.y4m':
+        return Y4MFrameWriter(path, image_size, fps, decimation)
+    elif extension == '.gif':
+        return AnimatedFrameWriter(path, image_size, fps, decimation, 'GIF')
+    elif extension in ('.png', '.apng'):
+        return AnimatedFrameWriter(path, image_size, fps, decimation, 'PNG')
+    raise ValueError('Unknown capture format for {:s}, expected one of {:s}'.format(path, ', '.join(capture_extensions)))
+
+
+# Hands frames off to a background thread for encoding; if the writer can't keep up frames are dropped,
+# rather than holding up the render loop we're trying to measure
+class FrameCaptureSink(object):
+    def __init__(self, path, fps=None, decimation=None, queue_size=None):
+        if fps is None:
+            fps = 60
+        if decimation is None:
+            decimation = 1  # Keep every frame
+        if queue_size is None:
+            queue_size = 120
+        self.path = path
+        self.fps = fps
+        self.decimation = decimation
+        if os.path.splitext(path)[1].lower() not in capture_extensions:
+            raise ValueError('Unknown capture format for {:s}, expected one of {:s}'.format(
+                path, ', '.join(capture_extensions)))
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.frames_seen = 0
+        self.frames_queued = 0
+        self.frames_dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='frame-capture', daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        if self.closed:
+            return
+        self.frames_seen += 1
+        if (self.frames_seen - 1) % self.decimation != 0:
+            return
+        try:
+            # Copy, since the renderer is free to reuse the image once it's been shown
+            self.queue.put_nowait(image.copy())
+            self.frames_queued += 1
+        except queue.Full:
+            self.frames_dropped += 1
+
+    def _run(self):
+        writer = None
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            if writer is None:
+                writer = create_writer(self.path, image.size, self.fps, self.decimation)
+                print('Capturing {:d}x{:d} frames at {:d}/{:d} fps to {:s}'.format(
+                    image.size[0], image.size[1], self.fps, self.decimation, self.path))
+            writer.write(image)
+        if writer is not None:
+            writer.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        print('Captured {:d} of {:d} frames to {:s}, dropped {:d}'.format(
+            self.frames_queued, self.frames_seen, self.path, self.frames_dropped))
+
+    def get_frames_dropped(self):
+        return self.frames_dropped
+
+    def get_frames_queued(self):
+        return self.frames_queued
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 import argparse
+import asyncio
+import atexit
+import concurrent.futures
 import datetime
 import json
 import os
+import random
 import time
 import tzlocal
 
@@ -12,9 +16,31 @@ import rpi_matrix
 import clock_pattern
 import weather_pattern
 import config
-
-
-def find_fonts(search_in, fit_height):
+import scheduler
+import render_process
+import capture
+import async_runtime
+import effects
+import brightness
+import quality
+import memory_tools
+import config_watch
+import watchdog
+import frametrace
+import weather
+
+
+# Longest we'll go between frames for a pattern that isn't animated, so late updates still show up promptly
+max_idle_time = 1.0
+# Everything create_memory_accounting keeps track of; only the ones that can give memory back can have a
+# --memory-budget, the rest are just reported
+memory_subsystems = ['effects', 'text-cache', 'frames', 'weather']
+budget_subsystems = ['effects', 'text-cache']
+
+
+def find_fonts(search_in, fit_height, time_func=None, font_cache=None):
+    if font_cache is None:
+        font_cache = {}
     found_fonts = ['DejaVuSans.ttf']
     search_path = os.path.join(search_in, 'fonts')
     if os.path.exists(search_path):
@@ -23,11 +49,44 @@ def find_fonts(search_in, fit_height):
             temp_file = os.path.join(search_path, fil)
             if os.path.isfile(temp_file) and temp_file[-4:].lower() == '.ttf':
                 found_fonts.append(temp_file)
-    generated_fonts = [render_tools.get_font_fit(font_name, fit_height) for font_name in found_fonts]
+    # Only fonts that are new, have changed on disk or are wanted at a new height are generated again
+    generated_fonts = []
+    used_keys = set()
+    for font_name in found_fonts:
+        key = (font_name, os.path.getmtime(font_name) if os.path.isfile(font_name) else None, fit_height)
+        if key not in font_cache:
+            font_cache[key] = render_tools.get_font_fit(font_name, fit_height, time_func=time_func)
+        used_keys.add(key)
+        generated_fonts.append(font_cache[key])
+    for key in list(font_cache.keys()):
+        if key not in used_keys:
+            del font_cache[key]
     found_fonts = {font_data.get_name(): font_data for font_data in generated_fonts}
     return found_fonts
 
 
+def datetime_from_string(string_in):
+    try:
+        parsed = datetime.datetime.strptime(string_in, '%Y-%m-%d %H:%M:%S')
+        return parsed.replace(tzinfo=tzlocal.get_localzone())
+    except ValueError:
+        raise argparse.ArgumentTypeError('Not a valid date and time: {:s}'.format(string_in))
+
+
+def memory_budget_from_string(string_in):
+    try:
+        (name, budget) = memory_tools.budget_from_string(string_in)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if name in memory_subsystems and name not in budget_subsystems:
+        raise argparse.ArgumentTypeError('Memory subsystem {:s} can\'t be shrunk, only {:s} can have a budget'.format(
+            name, ', '.join(budget_subsystems)))
+    if name not in budget_subsystems:
+        raise argparse.ArgumentTypeError('Unknown memory subsystem {:s}, expected one of {:s}'.format(
+            name, ', '.join(budget_subsystems)))
+    return (name, budget)
+
+
 def time_from_string(string_in):
     try:
         parsed = datetime.datetime.strptime(string_in, '%H:%M:%S')
@@ -39,6 +98,8 @@ def time_from_string(string_in):
 
 
 class NightClock(object):
+    switch_recheck = 60
+
     def __init__(self, morning_hour=None, night_hour=None, night_hour_switchover_callback=None):
         if morning_hour is None:
             morning_hour = 7
@@ -46,27 +107,62 @@ class NightClock(object):
             night_hour = 10+12
         self.morning_hour = datetime.time(hour=morning_hour)
         self.night_hour = datetime.time(hour=night_hour)
-        self.is_night_hours = False
+        self.night_hours = False
         self.night_hour_switchover_callback = night_hour_switchover_callback
+        self.switch_event = None
+
+    # Takes effect at the next update_time; schedule_switch again to move the next timed check
+    def set_hours(self, morning_hour, night_hour):
+        self.morning_hour = datetime.time(hour=morning_hour)
+        self.night_hour = datetime.time(hour=night_hour)
 
     def update_time(self, instant):
-        if not self.is_night_hours and (instant.time() > self.night_hour or instant.time() < self.morning_hour):
-            self.is_night_hours = True
+        if not self.night_hours and (instant.time() > self.night_hour or instant.time() < self.morning_hour):
+            self.night_hours = True
             if self.night_hour_switchover_callback is not None:
-                self.night_hour_switchover_callback(self.is_night_hours)
-        if self.is_night_hours and (self.night_hour >= instant.time() >= self.morning_hour):
-            self.is_night_hours = False
+                self.night_hour_switchover_callback(self.night_hours)
+        if self.night_hours and (self.night_hour >= instant.time() >= self.morning_hour):
+            self.night_hours = False
             if self.night_hour_switchover_callback is not None:
-                self.night_hour_switchover_callback(self.is_night_hours)
+                self.night_hour_switchover_callback(self.night_hours)
 
     def is_night_hours(self):
-        return self.is_night_hours
+        return self.night_hours
+
+    def get_next_switch(self, instant):
+        candidates = []
+        for days in (0, 1):
+            day = instant.date() + datetime.timedelta(days=days)
+            for switch_time in (self.morning_hour, self.night_hour):
+                candidate = datetime.datetime.combine(day, switch_time, tzinfo=instant.tzinfo)
+                if candidate > instant:
+                    candidates.append(candidate)
+        return min(candidates)
+
+    # Checks the time now, then again whenever we next cross into or out of night hours. The scheduler runs on the
+    # monotonic clock, and a DST change or NTP step moves the wall clock under it, so the check is made at least every
+    # switch_recheck seconds and the delay worked out again each time
+    def schedule_switch(self, scheduler, now_func):
+        now = now_func()
+        self.update_time(now)
+        # Both hours are exclusive, so check just after the boundary rather than on it
+        delay = min((self.get_next_switch(now) - now).total_seconds() + 1, self.switch_recheck)
+        if self.switch_event is not None:
+            self.switch_event.cancel()
+        self.switch_event = scheduler.schedule_in(delay, lambda: self.schedule_switch(scheduler, now_func),
+                                                  name='night-switch')
 
 
 class FunctionData(object):
-    def __init__(self, night_clock, fps_clock, size_data, debug_flags):
+    def __init__(self, night_clock, fps_clock, scheduler, size_data, debug_flags, time_source=None,
+                 quality_controller=None):
+        if time_source is None:
+            time_source = fps_tools.RealTimeSource()
+        self.time_source = time_source
+        self.quality_controller = quality_controller
         self.night_clock = night_clock
         self.fps_clock = fps_clock
+        self.scheduler = scheduler
         self.now = None
         self.size_data = size_data
         self.debug_flags = debug_flags
@@ -83,9 +179,25 @@ class FunctionData(object):
     def get_night_clock(self):
         return self.night_clock
 
+    def get_scheduler(self):
+        return self.scheduler
+
+    def get_time_source(self):
+        return self.time_source
+
+    # The quality level patterns should render at; None if quality isn't being managed
+    def get_quality(self):
+        if self.quality_controller is None:
+            return None
+        return self.quality_controller.get_level()
+
     def get_size_data(self):
         return self.size_data
 
+    # Only between frames; everything drawn at the old size has to be rebuilt along with it
+    def set_size_data(self, size_data):
+        self.size_data = size_data
+
     def get_debug_flags(self):
         return self.debug_flags
 
@@ -93,99 +205,632 @@ class FunctionData(object):
         return self.debug_flags.get(flag_name)
 
 
-def main():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug-fps', action='store_true', help='Enable the performance output')
     parser.add_argument('--debug-font', action='store_true',
                         help='Enable the font output (outputs font name when it changes)')
+    parser.add_argument('--debug-alloc', action='store_true', help='Output the number of images allocated each frame')
+    parser.add_argument('--debug-memory', action='store_true',
+                        help='Periodically output the memory held by each cache and table (traces Python allocations)')
+    parser.add_argument('--debug-memory-period', type=float, default=60,
+                        help='Seconds between memory snapshots')
+    parser.add_argument('--memory-report', default=None,
+                        help='Append each memory snapshot to this file as a line of JSON')
+    parser.add_argument('--memory-budget', type=memory_budget_from_string, action='append', default=[],
+                        help='Shrink a cache once it holds more than this, as SUBSYSTEM=KIB (may be repeated); '
+                             'SUBSYSTEM is one of {:s}'.format(', '.join(budget_subsystems)))
+    parser.add_argument('--trace', default=None,
+                        help='Record a binary trace of every frame to this file, for frametrace.py to summarize')
+    parser.add_argument('--trace-frames', type=int, default=frametrace.default_capacity,
+                        help='Frames the trace file holds before it wraps around and overwrites the oldest')
+    parser.add_argument('--trace-hours', type=float, default=None,
+                        help='Size the trace to hold this many hours at 60fps instead, e.g. 168 for a week (1.4GiB)')
+    parser.add_argument('--debug-events', action='store_true', help='Output the name of each timed event as it runs')
     parser.add_argument('--debug-single', action='store_true', help='Render a single frame')
     parser.add_argument('--debug-no-matrix', action='store_true', help='Use a fake matrix, discard output')
     parser.add_argument('--debug-no-matrix-save', action='store_true', help='Use a fake matrix, output to file')
+    parser.add_argument('--debug-capture', default=None,
+                        help='Use a fake matrix, streaming frames to a .rgb, .y4m, .gif or .png (APNG) file; GIF and '
+                             'APNG frames are held in memory, up to 32MiB, and written out as FILE, FILE-2, ...')
+    parser.add_argument('--debug-capture-every', type=int, default=1, help='Only capture every Nth frame')
+    parser.add_argument('--debug-capture-queue', type=int, default=120,
+                        help='Frames to buffer for the capture writer before dropping them')
     parser.add_argument('--debug-action', choices=['clock', 'weather'], help='Perform specific function rather than rotating through them')
     parser.add_argument('--debug-set-time', type=time_from_string, default=None, help='For the clock, set a specific time')
-    args = parser.parse_args()
-
-    debug_options = {
-        'fps': args.debug_fps,
-        'font': args.debug_font,
-        'single': args.debug_single,
-        'no-matrix': args.debug_no_matrix,
-        'no-matrix-save': args.debug_no_matrix_save,
-        'action': args.debug_action,
-        'set-time': args.debug_set_time
-    }
-
-    # Loop invariants
-    containing_dir = os.path.dirname(os.path.realpath(__file__))
-    size_cache_file = os.path.join(containing_dir, 'config.json')
-
-    # Display size cache
-    size_data = config.DisplayConfig()
-    if os.path.isfile(size_cache_file):
+    parser.add_argument('--sim-speed', type=float, default=None,
+                        help='Run on a virtual clock this many times faster than real time (0 runs as fast as possible)')
+    parser.add_argument('--sim-start', type=datetime_from_string, default=None,
+                        help='Virtual clock start, as "YYYY-MM-DD HH:MM:SS" (default: now)')
+    parser.add_argument('--sim-duration', type=float, default=None, help='Stop after this many virtual seconds')
+    parser.add_argument('--sim-seed', type=int, default=0, help='Random seed used for simulation runs')
+    parser.add_argument('--async', dest='run_async', action='store_true',
+                        help='Run the frame loop, weather refresh and control server on an asyncio event loop')
+    parser.add_argument('--control-port', type=int, default=None,
+                        help='With --async, listen on this port for control commands (status, memory, pattern NAME, quit)')
+    parser.add_argument('--control-host', default='127.0.0.1', help='Address the control server listens on')
+    parser.add_argument('--watchdog', action='store_true',
+                        help='Run the frame loop on a thread, restarting it (keeping fonts and caches) if it stalls')
+    parser.add_argument('--watchdog-timeout', type=float, default=5,
+                        help='Seconds without a frame heartbeat before the watchdog restarts the frame loop')
+    parser.add_argument('--debug-stall', type=float, default=None,
+                        help='With --watchdog, hang the first frame loop after this many seconds')
+    parser.add_argument('--render-process', action='store_true',
+                        help='Render in a separate process, handing frames to the display through shared memory')
+    parser.add_argument('--fixed-quality', action='store_true',
+                        help='Always render at full quality, rather than stepping down when frames run long')
+    parser.add_argument('--quality-config', default=None,
+                        help='JSON file of quality levels and thresholds for the adaptive quality controller')
+    parser.add_argument('--tile-workers', type=int, default=0,
+                        help='Composite multi-module displays one module at a time on this many threads (0 disables); '
+                             'slower than compositing whole frames under the GIL, see tilespeedtest.py')
+    parser.add_argument('--clock-effect', choices=effects.effect_types.keys(), default='rainbow',
+                        help='Background effect behind the clock text')
+    parser.add_argument('--clock-night-effect', choices=effects.effect_types.keys(), default=None,
+                        help='Background effect behind the clock text during night hours (default: same as --clock-effect)')
+    parser.add_argument('--weather-effect', choices=effects.effect_types.keys(), default=None,
+                        help='Background effect to fill the weather legend with (default: plain white)')
+    parser.add_argument('--weather-night-effect', choices=effects.effect_types.keys(), default=None,
+                        help='Effect for the weather legend during night hours (default: same as --weather-effect)')
+    parser.add_argument('--clock-badge', choices=['none', 'temperature'], default='none',
+                        help='Overlay shown in the corner of the clock')
+    parser.add_argument('--morning-hour', type=int, default=None,
+                        help='Hour (0-23) night hours end, overriding config.json (default 7)')
+    parser.add_argument('--night-hour', type=int, default=None,
+                        help='Hour (0-23) night hours begin, overriding config.json (default 22)')
+    parser.add_argument('--config-poll', type=float, default=2,
+                        help='Seconds between checks for changes to config.json and the fonts (0 disables live reload)')
+    parser.add_argument('--brightness-mode', choices=brightness.brightness_modes, default='hardware',
+                        help='Dim using the matrix brightness, a software LUT, or both')
+    parser.add_argument('--night-brightness', type=int, default=10, help='Brightness (percent) during night hours')
+    parser.add_argument('--brightness-ramp', type=float, default=300,
+                        help='Seconds taken to move between day and night brightness')
+    parser.add_argument('--gamma', type=float, default=1.0, help='Gamma correction applied to every frame')
+    args = parser.parse_args(argv)
+    if args.run_async and (args.render_process or args.sim_speed is not None):
+        parser.error('--async can\'t be combined with --render-process or --sim-speed')
+    if args.watchdog and (args.run_async or args.render_process):
+        parser.error('--watchdog can\'t be combined with --async or --render-process')
+    return args
+
+
+def load_clock_config(containing_dir):
+    config_file = os.path.join(containing_dir, 'config.json')
+
+    clock_config = config.ClockConfig()
+    if os.path.isfile(config_file):
         try:
-            with open(size_cache_file, 'r') as infil:
-                size_data = config.DisplayConfig.deserialize(json.load(infil))
+            clock_config = config.ClockConfig.load(config_file)
         except Exception as e:
-            print('Unable to load config data from {}: {}'.format(size_cache_file, str(e)))
+            print('Unable to load config data from {}: {}'.format(config_file, str(e)))
     else:
-        with open(size_cache_file, 'w') as outfil:
-            json.dump(size_data.serialize(), outfil)
+        with open(config_file, 'w') as outfil:
+            json.dump(clock_config.serialize(), outfil)
+    return clock_config
 
-    tz = tzlocal.get_localzone()
-    if args.debug_no_matrix:
-        matrix = rpi_matrix.FakeMatrix()
-    elif args.debug_no_matrix_save:
-        matrix = rpi_matrix.FakeMatrixSaving()
-    else:
-        matrix = rpi_matrix.real_matrix(size_data)
 
-    def night_hours_action(is_night):
-        if is_night:
-            matrix.brightness = 10
-        else:
-            matrix.brightness = 100
+def load_display_config(containing_dir):
+    return load_clock_config(containing_dir).get_display()
 
-    night_clock = NightClock(night_hour_switchover_callback=night_hours_action)
-    fps_clock = fps_tools.FPSClock(target_fps=60)
-    function_data = FunctionData(night_clock, fps_clock, size_data, debug_options)
 
-    fonts = find_fonts(containing_dir, size_data.get_height()*16)
+def create_matrix(args, size_data):
+    if args.debug_no_matrix:
+        return rpi_matrix.FakeMatrix()
+    elif args.debug_no_matrix_save:
+        return rpi_matrix.FakeMatrixSaving()
+    elif args.debug_capture is not None:
+        capture_sink = capture.FrameCaptureSink(args.debug_capture, decimation=args.debug_capture_every,
+                                                queue_size=args.debug_capture_queue)
+        atexit.register(capture_sink.close)
+        return rpi_matrix.FakeMatrixCapturing(capture_sink)
+    return rpi_matrix.real_matrix(size_data)
+
+
+# Stands in for effects.create_effect with effects that have already been built
+def prebuilt_effect_factory(prebuilt):
+    def effect_factory(name, size_data, color_table=None):
+        if name in prebuilt:
+            return prebuilt[name]
+        return effects.create_effect(name, size_data, color_table=color_table)
+    return effect_factory
+
+
+# Builds each effect once, so patterns asking for the same one share it
+def shared_effect_factory(effect_factory):
+    built = {}
+    def shared_factory(name, size_data, color_table=None):
+        if name not in built:
+            built[name] = effect_factory(name, size_data, color_table=color_table)
+        return built[name]
+    return shared_factory
+
+
+# Everything needed to produce frames; doesn't push them anywhere, so it can run wherever the frames are wanted
+class ClockRenderer(object):
+    def __init__(self, args, size_data, matrix, containing_dir=None, time_source=None, background_weather=None,
+                 warm_start=None):
+        if containing_dir is None:
+            containing_dir = os.path.dirname(os.path.realpath(__file__))
+        if time_source is None:
+            time_source = create_time_source(args)
+        self.args = args
+        self.time_source = time_source
+        self.containing_dir = containing_dir
+        self.size_data = size_data
+        self.background_weather = background_weather
+        self.clock_config = load_clock_config(containing_dir)
+        # The display driver sets up its panel chain once, when it's opened, so only fake matrices can change size
+        self.resizable = isinstance(matrix, rpi_matrix.FakeMatrix)
+        if args.debug_memory:
+            memory_tools.start_tracing()
+        self.debug_options = {
+            'fps': args.debug_fps,
+            'font': args.debug_font,
+            'events': args.debug_events,
+            'alloc': args.debug_alloc,
+            'single': args.debug_single,
+            'no-matrix': args.debug_no_matrix,
+            'no-matrix-save': args.debug_no_matrix_save,
+            'action': args.debug_action,
+            'set-time': args.debug_set_time
+        }
+
+        self.brightness_control = brightness.BrightnessControl(matrix, mode=args.brightness_mode, gamma=args.gamma,
+                                                               night_level=args.night_brightness,
+                                                               ramp_time=args.brightness_ramp)
+        (morning_hour, night_hour) = self.get_night_hours(self.clock_config)
+        self.night_clock = NightClock(morning_hour=morning_hour, night_hour=night_hour,
+                                      night_hour_switchover_callback=self.brightness_control.set_night)
+        self.quality_controller = None
+        if not args.fixed_quality:
+            if args.quality_config is not None:
+                self.quality_controller = quality.QualityController.load(args.quality_config)
+            else:
+                self.quality_controller = quality.QualityController()
+        self.fps_clock = fps_tools.FPSClock(target_fps=60, time_func=self.time_source.time)
+        if self.quality_controller is not None:
+            self.fps_clock.set_target_fps(self.quality_controller.get_level().get_target_fps())
+        self.scheduler = scheduler.EventScheduler(time_func=self.time_source.monotonic, debug=args.debug_events)
+        self.function_data = FunctionData(self.night_clock, self.fps_clock, self.scheduler, size_data,
+                                          self.debug_options, time_source=self.time_source,
+                                          quality_controller=self.quality_controller)
+        self.function_data.set_now(self.get_now())
+        self.night_clock.schedule_switch(self.scheduler, self.get_now)
+
+        # Fonts by file, modification time and height, so a reload only regenerates the fonts it has to
+        self.font_cache = {}
+        effect_factory = effects.create_effect
+        weather_cache = None
+        # Replacing a renderer (e.g. after a stall) takes over its fonts, effect tables and last weather, rather than
+        # paying for them all again. It may still wake up and carry on drawing, so we take copies of anything that
+        # changes as it's used, and leave it what it had
+        if warm_start is not None:
+            self.font_cache = {key: font.clone() for key, font in list(warm_start.font_cache.items())}
+            if warm_start.size_data.serialize() == size_data.serialize():
+                effect_factory = warm_start.get_effect_factory(clone=True)
+            weather_cache = warm_start.get_weather_pattern().get_weather_cache().clone()
+        if weather_cache is None:
+            weather_cache = self.create_weather_cache(self.clock_config, load_cached=True)
+        self.fonts = find_fonts(containing_dir, size_data.get_height()*16, time_func=self.time_source.now,
+                                font_cache=self.font_cache)
+
+        self.create_patterns(effect_factory, weather_cache)
+        if args.debug_alloc:
+            render_tools.allocations.install()
+        # Carries on in the same trace as a renderer we're replacing; pages are written back by the OS as they're
+        # touched, so nothing is lost if we're killed rather than closed
+        self.tracer = None
+        if warm_start is not None:
+            self.tracer = warm_start.tracer
+        elif args.trace is not None:
+            capacity = args.trace_frames
+            if args.trace_hours is not None:
+                capacity = frametrace.capacity_for_hours(args.trace_hours)
+            self.tracer = frametrace.FrameTraceWriter(args.trace, capacity=capacity)
+        if self.tracer is not None:
+            self.tracer.set_owner(self)
+        self.trace_times = [0, 0, 0]
+        self.trace_cache_counts = (0, 0)
+        self.trace_dropped = False
+
+        self.pattern_rotation = fps_tools.DTAwareObjectRotation(choices=self.patterns.keys(), initial_choice='clock')
+        self.scheduler.schedule_periodic(10, self.pattern_rotation.rotate_object, name='pattern-rotation')
+
+        # Config changes are prepared on a worker thread, then swapped in between frames
+        self.config_watcher = None
+        self.reload_executor = None
+        self.pending_reload = None
+        if args.config_poll > 0:
+            self.config_watcher = config_watch.FileWatcher(paths=[os.path.join(containing_dir, 'config.json')],
+                                                           directories=[os.path.join(containing_dir, 'fonts')])
+            self.reload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.scheduler.schedule_periodic(args.config_poll, self.check_config, name='config-check')
+
+        self.memory_accounting = self.create_memory_accounting()
+        for (name, budget) in args.memory_budget:
+            self.memory_accounting.set_budget(name, budget)
+        if args.debug_memory or args.memory_report is not None or self.memory_accounting.has_budgets():
+            self.scheduler.schedule_periodic(args.debug_memory_period, self.check_memory, name='memory-check')
+
+    def get_night_hours(self, clock_config):
+        # Hours given on the command line win over the config file
+        night_hours = clock_config.get_night_hours()
+        morning_hour = self.args.morning_hour if self.args.morning_hour is not None else night_hours.get_morning_hour()
+        night_hour = self.args.night_hour if self.args.night_hour is not None else night_hours.get_night_hour()
+        return (morning_hour, night_hour)
+
+    def create_weather_cache(self, clock_config, load_cached):
+        weather_config = clock_config.get_weather()
+        return weather.WeatherCache(zip_code=weather_config.get_zip_code(), country=weather_config.get_country(),
+                                    time_func=self.time_source.now, load_cached=load_cached)
+
+    # Hands out the effects we already have, for new patterns at the same size
+    # With `clone`, for a renderer that may run alongside this one, each gets its own copy
+    def get_effect_factory(self, clone=None):
+        if clone is None:
+            clone = False
+        prebuilt = {}
+        for pattern in self.patterns.values():
+            prebuilt.update(pattern.get_effects())
+        if clone:
+            clones = {effect: effect.clone() for effect in set(prebuilt.values())}
+            prebuilt = {name: clones[effect] for name, effect in prebuilt.items()}
+        return prebuilt_effect_factory(prebuilt)
+
+    def get_effect_names(self):
+        names = [self.args.clock_effect, self.args.clock_night_effect, self.args.weather_effect,
+                 self.args.weather_night_effect]
+        return set(name for name in names if name is not None)
+
+    # Effects are shared between patterns, so each is only counted once
+    def get_unique_effects(self):
+        effects_used = {}
+        for pattern in self.patterns.values():
+            effects_used.update(pattern.get_effects())
+        return list(set(effects_used.values()))
+
+    def get_effect_bytes(self):
+        return sum(effect.get_image_bytes() for effect in self.get_unique_effects())
+
+    # Each effect gives back its share, in proportion to what it holds
+    def shrink_effects(self, max_bytes):
+        total = self.get_effect_bytes()
+        if total == 0:
+            return
+        for effect in self.get_unique_effects():
+            effect.shrink(int(max_bytes * effect.get_image_bytes() / total))
+
+    def create_patterns(self, effect_factory, weather_cache):
+        effect_factory = shared_effect_factory(effect_factory)
+        self.weather_pat = weather_pattern.WeatherPattern(self.function_data, self.fonts, weather_cache=weather_cache,
+                                                          background_fetch=self.background_weather,
+                                                          day_effect=self.args.weather_effect,
+                                                          night_effect=self.args.weather_night_effect,
+                                                          effect_factory=effect_factory)
+        overlays = []
+        if self.args.clock_badge == 'temperature':
+            overlays.append(self.weather_pat.create_temperature_badge())
+        self.clock_pat = clock_pattern.ClockPattern(self.function_data, self.fonts, day_effect=self.args.clock_effect,
+                                                    night_effect=self.args.clock_night_effect,
+                                                    tile_workers=self.args.tile_workers, effect_factory=effect_factory,
+                                                    overlays=overlays)
+        self.patterns = {
+            'clock': self.clock_pat,
+            'weather': self.weather_pat
+        }
+        self.pattern = self.clock_pat
+        for pattern in self.patterns.values():
+            pattern.set_active(pattern is self.pattern)
+
+    # Patterns keep some of their timed events to themselves while they're off screen
+    def set_pattern(self, pattern):
+        if pattern is self.pattern:
+            return
+        self.pattern.set_active(False)
+        pattern.set_active(True)
+        self.pattern = pattern
 
-    clock_pat = clock_pattern.ClockPattern(function_data, fonts)
-    weather_pat = weather_pattern.WeatherPattern(function_data, fonts)
-    patterns = {
-        'clock': clock_pat,
-        'weather': weather_pat
-    }
+    def check_config(self):
+        if self.pending_reload is not None:
+            return
+        changed = self.config_watcher.poll()
+        if len(changed) == 0:
+            return
+        self.pending_reload = self.reload_executor.submit(self.prepare_reload, changed)
+        # Swap as soon as it's ready, which is always at the start of a frame, since that's when events run
+        self.pending_reload.add_done_callback(
+            lambda future: self.scheduler.schedule_in(0, self.apply_reload, name='config-swap'))
+
+    # Runs on the reload thread: only reads what the render thread owns, everything it builds is new
+    def prepare_reload(self, changed):
+        config_file = os.path.join(self.containing_dir, 'config.json')
+        new_config = config.ClockConfig.load(config_file)
+        old_config = self.clock_config
+        prepared = config_watch.PreparedReload(new_config)
+
+        size_data = self.size_data
+        if new_config.get_display().serialize() != old_config.get_display().serialize():
+            if self.resizable:
+                size_data = new_config.get_display()
+                prepared.size_data = size_data
+                prepared.add_change('display {:d}x{:d}'.format(size_data.get_width(), size_data.get_height()))
+            else:
+                print('Panel layout changed in {:s}, restart to use it'.format(config_file))
+        fonts_changed = any(self.config_watcher.is_watched_directory(path) for path in changed)
+        if prepared.size_data is not None or fonts_changed:
+            prepared.fonts = find_fonts(self.containing_dir, size_data.get_height()*16, time_func=self.time_source.now,
+                                        font_cache=self.font_cache)
+            if fonts_changed:
+                prepared.add_change('fonts')
+        if prepared.size_data is not None:
+            # The effects are the slow part of a new size, their precomputed images are all sized to the display
+            names = self.get_effect_names()
+            color_table = render_tools.gen_color_table(saturation=80)
+            prepared.effects = {name: effects.create_effect(name, size_data, color_table=color_table) for name in names}
+        if self.get_night_hours(new_config) != self.get_night_hours(old_config):
+            prepared.night_hours = self.get_night_hours(new_config)
+            prepared.add_change('night hours {:d}-{:d}'.format(prepared.night_hours[1], prepared.night_hours[0]))
+        if new_config.get_weather().serialize() != old_config.get_weather().serialize():
+            prepared.weather_cache = self.create_weather_cache(new_config, load_cached=False)
+            prepared.add_change('weather location {:s} {:s}'.format(new_config.get_weather().get_zip_code(),
+                                                                     new_config.get_weather().get_country()))
+        return prepared
+
+    # Runs between frames on the render thread, so the display only ever sees the old state or the new one
+    def apply_reload(self):
+        future = self.pending_reload
+        self.pending_reload = None
+        try:
+            prepared = future.result()
+        except Exception as e:
+            print('Unable to reload config: {:s}'.format(str(e)))
+            return
+        if prepared.night_hours is not None:
+            self.night_clock.set_hours(prepared.night_hours[0], prepared.night_hours[1])
+            self.night_clock.schedule_switch(self.scheduler, self.get_now)
+        if prepared.size_data is not None:
+            self.size_data = prepared.size_data
+            self.function_data.set_size_data(self.size_data)
+        if prepared.fonts is not None:
+            self.fonts = prepared.fonts
+        weather_cache = prepared.weather_cache
+        if prepared.rebuilds_patterns():
+            if prepared.effects is not None:
+                effect_factory = prebuilt_effect_factory(prepared.effects)
+            else:
+                # Same size, so the effects we have still fit
+                effect_factory = self.get_effect_factory()
+            if weather_cache is None:
+                weather_cache = self.weather_pat.get_weather_cache()
+            old_patterns = list(self.patterns.values())
+            self.create_patterns(effect_factory, weather_cache)
+            for pattern in old_patterns:
+                pattern.close()
+        elif weather_cache is not None:
+            self.weather_pat.set_weather_cache(weather_cache)
+        self.clock_config = prepared.get_clock_config()
+        if len(prepared.get_changes()) > 0:
+            print('Reloaded config: {:s}'.format(', '.join(prepared.get_changes())))
+
+    def create_memory_accounting(self):
+        accounting = memory_tools.MemoryAccounting(trace_python=self.args.debug_memory, time_func=self.time_source.time)
+        def measure_text():
+            return sum(font.get_bm_font().get_image_bytes() for font in self.fonts.values())
+
+        def shrink_text(max_bytes):
+            # Each font gives up its share, in proportion to what it's holding
+            total = measure_text()
+            for bm_font in [font.get_bm_font() for font in self.fonts.values()]:
+                bm_font.shrink(int(max_bytes * bm_font.get_image_bytes() / total))
+
+        def measure_frames():
+            return memory_tools.image_bytes(self.clock_pat.black_image) + self.clock_pat.get_layer_bytes()
+
+        accounting.add_subsystem('effects', self.get_effect_bytes, shrink_func=self.shrink_effects,
+                                 python_files=['effects.py'])
+        accounting.add_subsystem('text-cache', measure_text, shrink_func=shrink_text,
+                                 python_files=['render_tools.py', 'font_utils.py'])
+        accounting.add_subsystem('frames', measure_frames, python_files=['tiles.py', 'layers.py'])
+        accounting.add_subsystem('weather', lambda: self.weather_pat.get_image_bytes(),
+                                 python_files=['weather.py', 'weather_pattern.py'])
+        return accounting
+
+    def get_memory_snapshot(self):
+        return self.memory_accounting.snapshot()
+
+    def check_memory(self):
+        for (name, before, after) in self.memory_accounting.enforce_budgets():
+            if self.args.debug_memory:
+                print('Shrunk {:s} from {:.1f}KiB to {:.1f}KiB'.format(name, before / 1024, after / 1024))
+        if not self.args.debug_memory and self.args.memory_report is None:
+            return
+        snapshot = self.memory_accounting.snapshot()
+        if self.args.debug_memory:
+            print(memory_tools.format_snapshot(snapshot))
+        if self.args.memory_report is not None:
+            try:
+                memory_tools.append_snapshot(self.args.memory_report, snapshot)
+            except Exception as e:
+                print('Unable to write memory report to {:s}: {:s}'.format(self.args.memory_report, str(e)))
 
-    pattern_rotation = fps_tools.DTAwareObjectRotation(d_dt=1, limit=10, choices=patterns.keys(), initial_choice='clock')
+    def get_now(self):
+        if self.args.debug_set_time is not None:
+            return self.args.debug_set_time
+        return self.time_source.now()
+
+    def get_fps_clock(self):
+        return self.fps_clock
 
-    while True:
+    def get_time_source(self):
+        return self.time_source
+
+    def sleep(self, seconds):
+        self.time_source.sleep(seconds)
+
+    def get_function_data(self):
+        return self.function_data
+
+    def get_weather_pattern(self):
+        return self.weather_pat
+
+    def get_pattern_names(self):
+        return list(self.patterns.keys())
+
+    # Pins the display to one pattern, as with --debug-action; None goes back to rotating through them
+    def set_pattern_override(self, name):
+        if name is not None and name not in self.patterns:
+            raise ValueError('Unknown pattern {:s}, expected one of {:s}'.format(name, ', '.join(self.patterns.keys())))
+        self.debug_options['action'] = name
+
+    def get_status(self):
+        fps_clock = self.fps_clock
+        return {
+            'now': str(self.function_data.get_now()),
+            'pattern': self.debug_options.get('action') or self.pattern_rotation.get_current_object(),
+            'night': self.night_clock.is_night_hours(),
+            'quality': None if self.quality_controller is None else self.quality_controller.get_level().get_name(),
+            'brightness': self.brightness_control.get_level(),
+            'render-time': fps_clock.get_last_render_time(),
+            'dt': fps_clock.get_dt(),
+            'target-dt': fps_clock.get_dt_target(),
+        }
+
+    def render_frame(self):
+        fps_clock = self.fps_clock
         fps_clock.start_frame()
+        render_tools.allocations.start_frame()
+        if self.tracer is not None:
+            self.trace_times[0] = time.monotonic_ns()
 
         # Update the pattern in progress
-        function_data.set_now(datetime.datetime.now(tz))
-        if args.debug_set_time is not None:
-            function_data.set_now(args.debug_set_time)
-        night_clock.update_time(function_data.get_now())
-        pattern_rotation.dt(fps_clock.get_dt())
-        pattern = patterns.get(pattern_rotation.get_current_object(), clock_pat)
-        if debug_options.get('action') is not None:
-            pattern = patterns.get(debug_options.get('action'), clock_pat)
-        img = pattern.frame(fps_clock.get_dt())
-        matrix.SetImage(img, 0, 0)
-
-        # Perform the FPS counting
+        self.function_data.set_now(self.get_now())
+        self.scheduler.run_due()
+        self.pattern_name = self.pattern_rotation.get_current_object()
+        if self.debug_options.get('action') is not None:
+            self.pattern_name = self.debug_options.get('action')
+        self.set_pattern(self.patterns.get(self.pattern_name, self.clock_pat))
+        img = self.pattern.render(fps_clock.get_dt())
+        self.brightness_control.dt(fps_clock.get_dt())
+        img = self.brightness_control.apply(img)
+        if self.tracer is not None:
+            self.trace_times[1] = time.monotonic_ns()
+        return img
+
+    # Call once the frame has been handed off; returns how long to sleep before the next one
+    def finish_render(self):
+        fps_clock = self.fps_clock
         fps_clock.finish_render()
+        if self.tracer is not None:
+            self.trace_times[2] = time.monotonic_ns()
+            self.trace_dropped = fps_clock.get_sleep_time() < 0
+        frame_allocations = render_tools.allocations.finish_frame()
+        if self.quality_controller is not None \
+           and self.quality_controller.add_render_time(fps_clock.get_last_render_time(), fps_clock.get_dt()):
+            level = self.quality_controller.get_level()
+            fps_clock.set_target_fps(level.get_target_fps())
+            if self.args.debug_fps:
+                print('Quality level now {:s}'.format(level.get_name()))
         sleep_time = fps_clock.get_sleep_time()
-        if args.debug_fps:
-            print('Frame time {:.3f} Target {:.3f} Sleep Time {:.3f}'.format(fps_clock.get_last_render_time(),
-                                                                             fps_clock.get_dt_target(), sleep_time))
+        if not self.pattern.is_animated():
+            # Nothing changes on screen until something is due, so don't bother drawing it again before then
+            idle_time = self.scheduler.get_time_until_next()
+            if idle_time is None:
+                idle_time = max_idle_time
+            sleep_time = max(sleep_time, min(idle_time, max_idle_time))
+        if self.args.debug_fps:
+            quality_name = 'fixed' if self.quality_controller is None else self.quality_controller.get_level().get_name()
+            print('Frame time {:.3f} Target {:.3f} Sleep Time {:.3f} Quality {:s}'.format(
+                fps_clock.get_last_render_time(), fps_clock.get_dt_target(), sleep_time, quality_name))
+        if self.args.debug_alloc:
+            print('Images allocated {:d}'.format(frame_allocations))
+        return sleep_time
+
+    def finish_frame(self):
+        self.fps_clock.finish_frame()
+        if self.tracer is not None:
+            self.write_trace()
+
+    def write_trace(self):
+        (hits, misses) = (0, 0)
+        for font in self.fonts.values():
+            (font_hits, font_misses) = font.get_bm_font().get_cache_counts()
+            hits += font_hits
+            misses += font_misses
+        (last_hits, last_misses) = self.trace_cache_counts
+        self.trace_cache_counts = (hits, misses)
+        font = self.pattern.get_font()
+        quality_name = 'fixed' if self.quality_controller is None else self.quality_controller.get_level().get_name()
+        self.tracer.write(self.trace_times[0], self.trace_times[1], self.trace_times[2], time.monotonic_ns(),
+                          self.pattern_name, font.get_name() if font is not None else '', quality_name,
+                          max(0, hits - last_hits), max(0, misses - last_misses), self.trace_dropped, owner=self)
+
+    # Stops the patterns' timed events and worker threads; the renderer isn't used again afterwards
+    def close(self):
+        for pattern in self.patterns.values():
+            pattern.close()
+        if self.reload_executor is not None:
+            self.reload_executor.shutdown(wait=False)
+
+
+def create_time_source(args):
+    tz = tzlocal.get_localzone()
+    if args.sim_speed is None:
+        return fps_tools.RealTimeSource(tz)
+    # Simulation runs should be repeatable, so pin down the font choices
+    random.seed(args.sim_seed)
+    start = args.sim_start if args.sim_start is not None else datetime.datetime.now(tz)
+    return fps_tools.VirtualTimeSource(start, speed=args.sim_speed)
+
+
+# Runs frames until a simulation is over (forever otherwise); show_frame returns False once the loop should stop
+def run_frames(args, renderer, show_frame):
+    time_source = renderer.get_time_source()
+    start_time = time_source.monotonic()
+    real_start_time = time.monotonic()
+    frames = 0
+    while args.sim_duration is None or time_source.monotonic() - start_time < args.sim_duration:
+        img = renderer.render_frame()
+        if not show_frame(img):
+            return
+        frames += 1
+
+        sleep_time = renderer.finish_render()
         if args.debug_single:
             return
         if sleep_time > 0:
-            time.sleep(sleep_time)
-        fps_clock.finish_frame()
+            renderer.sleep(sleep_time)
+        renderer.finish_frame()
+    real_time = time.monotonic() - real_start_time
+    print('Simulated {:.0f}s in {:.1f}s: {:d} frames, {:.1f} frames per real second'.format(
+        time_source.monotonic() - start_time, real_time, frames, frames / real_time if real_time > 0 else 0))
+
+
+def main():
+    args = parse_args()
+
+    # Loop invariants
+    containing_dir = os.path.dirname(os.path.realpath(__file__))
+    size_data = load_display_config(containing_dir)
+    matrix = create_matrix(args, size_data)
+
+    if args.render_process:
+        render_process.run_display(args, size_data, matrix)
+        return
+    if args.run_async:
+        asyncio.run(async_runtime.run(args, size_data, matrix, containing_dir=containing_dir))
+        return
+
+    if args.watchdog:
+        watchdog.Watchdog(args, size_data, matrix, containing_dir=containing_dir).run()
+        return
+
+    renderer = ClockRenderer(args, size_data, matrix, containing_dir=containing_dir)
+
+    def show_frame(img):
+        matrix.SetImage(img, 0, 0)
+        return True
+    run_frames(args, renderer, show_frame)
+
 
 
 if __name__ == '__main__':
@@ -1,8 +1,11 @@
 import fps_tools
 import render_tools
 import font_utils
+import layers
 import math
+import memory_tools
 import patterns
+import tiles
 from PIL import Image
 
 time_fmt = '%I:%M:%S%p'
@@ -10,8 +13,13 @@ date_fmt = '%b %d %Y'
 
 
 class ClockPattern(patterns.DisplayPattern):
-    def __init__(self, function_data, fonts):
+    def __init__(self, function_data, fonts, day_effect=None, night_effect=None, tile_workers=None,
+                 effect_factory=None, overlays=None):
         super().__init__(function_data, fonts)
+        if day_effect is None:
+            day_effect = 'rainbow'
+        if overlays is None:
+            overlays = []
         self.font_collection = font_utils.FontCollection(self.fonts)
         self.font = self.font_collection.get_current_font()
         debug_font = self.function_data.get_debug_flag('font')
@@ -21,24 +29,39 @@ class ClockPattern(patterns.DisplayPattern):
         # dT dependent data
         # Units are increments of pi per second; one full circle is 2 pi, so this is roughly one circle per 10s
         self.movement_rotation = fps_tools.DTAwareRotation(d_dt=math.pi/5)
-        # Ditto, this is roughly one full rainbow rotation per 6s
-        self.color_rotation = fps_tools.DTAwareRotation(d_dt=math.pi/3)
-        # Unit is Hz, we want to rotate the fonts once every 30s
-        self.font_rotation = fps_tools.DTAwarePeriodicValue(d_dt=1, limit=30, reset_func=lambda: self.choose_new_font())
-        # Ditto, we want to invert the display once every 60s
-        self.invert_toggle = fps_tools.DTAwarePeriodicValue(d_dt=1, limit=60, reset_func=lambda: self.invert_display())
+
+        # Rare events; units are seconds. We want to rotate the fonts once every 30s, and invert once every 60s, counting
+        # only the time the clock is on screen
+        self.schedule_periodic(30, self.choose_new_font, name='font-rotation', while_active=True)
+        self.schedule_periodic(60, self.invert_display, name='invert-display', while_active=True)
 
         # Normal variables
         self.inverted = False
+        # Where each line of text goes this frame, as ((x, y), text)
+        self.text_layout = []
 
         # Cached data
-        self.color_table = render_tools.gen_color_table(saturation=80)
         self.black_image = render_tools.gen_black_image(function_data.get_size_data().get_image_size())
-        self.rainbow_image_table = [
-            render_tools.gen_rainbow_image(
-                rot, self.color_table, function_data.get_size_data().get_image_size()
-            ) for rot in range(360)
-        ]
+        size_data = function_data.get_size_data()
+        self.create_effects(day_effect, night_effect=night_effect, effect_factory=effect_factory)
+        # Only worth splitting the frame up if there's more than one module to split it into
+        self.tile_compositor = None
+        if tile_workers is not None and tile_workers > 0 and size_data.get_width() * size_data.get_height() > 1:
+            self.tile_compositor = tiles.TileCompositor(size_data, max_workers=tile_workers)
+        # Overlays (e.g. a weather badge) go on top of the text
+        self.layers = layers.LayerStack(size_data.get_image_size())
+        if self.tile_compositor is None:
+            self.layers.add_layer(ClockBackgroundLayer(self))
+            self.layers.add_layer(ClockTextLayer(self, size_data.get_image_size()))
+        else:
+            self.layers.add_layer(ClockTileLayer(self, self.tile_compositor, size_data.get_module_size()))
+        for overlay in overlays:
+            self.layers.add_layer(overlay)
+
+    def close(self):
+        super().close()
+        if self.tile_compositor is not None:
+            self.tile_compositor.shutdown()
 
     def choose_new_font(self):
         self.font = self.font_collection.choose_font()
@@ -49,12 +72,47 @@ class ClockPattern(patterns.DisplayPattern):
     def invert_display(self):
         self.inverted = not self.inverted
 
+    def reset(self, rotation, font=None, inverted=None):
+        if font is not None:
+            self.font = font
+        if inverted is not None:
+            self.inverted = inverted
+        self.movement_rotation.set_value(rotation)
+        super().reset(rotation)
+
+    # The effect and black swap places when the display is inverted; returns (image, key)
+    def get_fill(self, text):
+        if text != self.inverted:
+            return (self.background, self.background_key)
+        return (self.black_image, 'black')
+
+    def get_text_key(self):
+        return (self.font.get_bm_font(), tuple(self.text_layout))
+
+    def draw_text(self, mask):
+        bitmap_drawing = self.font.get_bm_font()
+        for (position, text) in self.text_layout:
+            bitmap_drawing.text(position, mask, text)
+
+    # The text broken down into the pastes that draw it, as (layout entry, [(image, position)]); these come from the
+    # font's caches, so they have to be fetched here rather than on a tile thread
+    def get_text_pastes(self):
+        bitmap_drawing = self.font.get_bm_font()
+        return [(entry, bitmap_drawing.get_pastes(entry[0], entry[1])) for entry in self.text_layout]
+
+    def get_layer_bytes(self):
+        return self.layers.get_image_bytes()
+
     def frame(self, dt):
+        # The layers draw into buffers of their own, and keep the frame for the next one
+        frame = self.render(dt)
+        return None if frame is None else frame.copy()
+
+    def render(self, dt):
         # Update all our dT-dependent data
-        self.movement_rotation.dt(dt)
-        self.color_rotation.dt(dt)
-        self.font_rotation.dt(dt)
-        self.invert_toggle.dt(dt)
+        quality = self.function_data.get_quality()
+        if quality is None or quality.get_motion():
+            self.movement_rotation.dt(dt)
 
         now = self.function_data.get_now()
         if now is None:
@@ -69,7 +127,6 @@ class ClockPattern(patterns.DisplayPattern):
         size_data = self.function_data.get_size_data()
         image_size = size_data.get_image_size()
 
-        alpha_img = Image.new("L", image_size)
         half_img_x = int(image_size[0]/2.0)
         time_x_var = abs(time_str_size - image_size[0])
         date_x_var = abs(date_str_size - image_size[0])
@@ -78,8 +135,10 @@ class ClockPattern(patterns.DisplayPattern):
 
         if time_str_size < image_size[0] and date_str_size < image_size[0]:
             # draw it once
-            bitmap_drawing.text((int(half_img_x-half_time_x), 0), alpha_img, time_str)
-            bitmap_drawing.text((int(half_img_x-half_date_x), size_data.get_height()*16), alpha_img, date_str)
+            self.text_layout = [
+                ((int(half_img_x-half_time_x), 0), time_str),
+                ((int(half_img_x-half_date_x), size_data.get_height()*16), date_str),
+            ]
         else:
             # animate it bouncing left to right
             time_x_inc = 0 if time_str_size <= image_size[0] else time_x_var
@@ -87,11 +146,114 @@ class ClockPattern(patterns.DisplayPattern):
 
             sin_var = math.sin(self.movement_rotation.get_rotation())
 
-            bitmap_drawing.text((int(round(sin_var * (time_x_inc / 2.0) - half_time_x + half_img_x)), 0), alpha_img, time_str)
-            bitmap_drawing.text((int(round(sin_var * (date_x_inc / 2.0) - half_date_x + half_img_x)), size_data.get_height()*16), alpha_img, date_str)
-        fg = self.rainbow_image_table[int(self.color_rotation.get_rotation_degrees())]
-        bg = self.black_image
-        if not self.inverted:
-            return Image.composite(fg, bg, alpha_img).convert("RGB")
-        else:
-            return Image.composite(bg, fg, alpha_img).convert("RGB")
+            self.text_layout = [
+                ((int(round(sin_var * (time_x_inc / 2.0) - half_time_x + half_img_x)), 0), time_str),
+                ((int(round(sin_var * (date_x_inc / 2.0) - half_date_x + half_img_x)), size_data.get_height()*16),
+                 date_str),
+            ]
+        self.advance_background(self.get_effect(), dt, quality, render=self.tile_compositor is None)
+        # Only the layers that changed are drawn again
+        return self.layers.compose()
+
+
+# Behind the text: black, or the effect when inverted
+class ClockBackgroundLayer(layers.Layer):
+    def __init__(self, pattern):
+        super().__init__()
+        self.pattern = pattern
+
+    def get_key(self):
+        return self.pattern.get_fill(False)[1]
+
+    def get_image(self):
+        return self.pattern.get_fill(False)[0]
+
+
+# The time and date, filled with the effect (or black when inverted); the text is only drawn again when it moves or
+# changes, not when just the fill does
+class ClockTextLayer(layers.Layer):
+    def __init__(self, pattern, image_size):
+        super().__init__()
+        self.pattern = pattern
+        self.box = (0, 0, image_size[0], image_size[1])
+        self.mask = Image.new('L', image_size)
+        self.text_key = layers.unset_key
+
+    def get_key(self):
+        return (self.pattern.get_text_key(), self.pattern.get_fill(True)[1])
+
+    def draw(self):
+        text_key = self.pattern.get_text_key()
+        if text_key == self.text_key:
+            return
+        self.text_key = text_key
+        self.mask.paste(0, self.box)
+        self.pattern.draw_text(self.mask)
+
+    def get_image(self):
+        return self.pattern.get_fill(True)[0]
+
+    def get_mask(self):
+        return self.mask
+
+    def get_image_bytes(self):
+        return memory_tools.image_bytes(self.mask)
+
+
+# Draws one module: the text that falls on it, filled with its part of the effect (or black when inverted). Runs on a
+# tile thread, so it only reads what it's given
+def render_clock_tile(box, effect, black_tile, pastes, inverted):
+    if len(pastes) == 0 and not inverted:
+        return black_tile
+    mask = Image.new('L', black_tile.size)
+    for (image, position) in pastes:
+        mask.paste(image, (position[0] - box[0], position[1] - box[1]))
+    fill = effect.render_box(box)
+    if inverted:
+        return Image.composite(black_tile, fill, mask)
+    return Image.composite(fill, black_tile, mask)
+
+
+# The background and text together, drawn a module at a time on the tile compositor's threads, in place of the
+# background and text layers. A module is only drawn again when its part of the text or the effect changed
+class ClockTileLayer(layers.Layer):
+    def __init__(self, pattern, tile_compositor, module_size):
+        super().__init__()
+        self.pattern = pattern
+        self.tile_compositor = tile_compositor
+        self.black_tile = Image.new('RGB', module_size)
+        self.image = None
+
+    def get_key(self):
+        return (self.pattern.get_text_key(), self.pattern.background_key, self.pattern.inverted)
+
+    def draw(self):
+        effect = self.pattern.background_effect
+        inverted = self.pattern.inverted
+        text_pastes = self.pattern.get_text_pastes()
+        pastes_by_box = {}
+        tile_keys = []
+        for box in self.tile_compositor.get_boxes():
+            entries = []
+            pastes = []
+            for (entry, entry_pastes) in text_pastes:
+                on_tile = [(image, position) for (image, position) in entry_pastes if tiles.boxes_overlap(
+                    box, (position[0], position[1], position[0] + image.size[0], position[1] + image.size[1]))]
+                if len(on_tile) > 0:
+                    entries.append(entry)
+                    pastes.extend(on_tile)
+            pastes_by_box[box] = pastes
+            if len(pastes) == 0 and not inverted:
+                # Plain black, whatever the effect is doing
+                tile_keys.append('black')
+            else:
+                tile_keys.append((self.pattern.font.get_bm_font(), tuple(entries), self.pattern.background_key,
+                                  inverted))
+        self.image = self.tile_compositor.render(
+            lambda box: render_clock_tile(box, effect, self.black_tile, pastes_by_box[box], inverted), tile_keys)
+
+    def get_image(self):
+        return self.image
+
+    def get_image_bytes(self):
+        return memory_tools.count_image_bytes(self.tile_compositor.get_frames() + [self.black_tile])
@@ -1,3 +1,6 @@
+import json
+
+
 class DisplayConfig(object):
     def __init__(self, width=None, height=None, module_size=None):
         if width is None:
@@ -13,7 +16,7 @@ class DisplayConfig(object):
         self.height = height
         # The size of one single module; all modules must be the same topography
         # It's also recommended to buy them all in one purchase, as they can have differing controllers
-        self.module_size = module_size
+        self.module_size = tuple(module_size)
 
         # Cached, because this won't change (though it is derived)
         self.image_size = (
@@ -47,3 +50,104 @@ class DisplayConfig(object):
             height=json_obj.get('height'),
             module_size=json_obj.get('module-size')
         )
+
+
+class NightHoursConfig(object):
+    def __init__(self, morning_hour=None, night_hour=None):
+        if morning_hour is None:
+            morning_hour = 7
+        if night_hour is None:
+            night_hour = 22
+        # Hours (0-23) night hours end and begin
+        self.morning_hour = morning_hour
+        self.night_hour = night_hour
+
+    def get_morning_hour(self):
+        return self.morning_hour
+
+    def get_night_hour(self):
+        return self.night_hour
+
+    def serialize(self):
+        return {
+            'morning-hour': self.morning_hour,
+            'night-hour': self.night_hour
+        }
+
+    @classmethod
+    def deserialize(cls, json_obj):
+        return cls(
+            morning_hour=json_obj.get('morning-hour'),
+            night_hour=json_obj.get('night-hour')
+        )
+
+
+class WeatherConfig(object):
+    def __init__(self, zip_code=None, country=None):
+        if zip_code is None:
+            zip_code = '27529'
+        if country is None:
+            country = 'US'
+        self.zip_code = zip_code
+        self.country = country
+
+    def get_zip_code(self):
+        return self.zip_code
+
+    def get_country(self):
+        return self.country
+
+    def serialize(self):
+        return {
+            'zip-code': self.zip_code,
+            'country': self.country
+        }
+
+    @classmethod
+    def deserialize(cls, json_obj):
+        return cls(
+            zip_code=json_obj.get('zip-code'),
+            country=json_obj.get('country')
+        )
+
+
+# Everything in config.json; the display settings stay at the top level so older files still load
+class ClockConfig(object):
+    def __init__(self, display=None, night_hours=None, weather=None):
+        if display is None:
+            display = DisplayConfig()
+        if night_hours is None:
+            night_hours = NightHoursConfig()
+        if weather is None:
+            weather = WeatherConfig()
+        self.display = display
+        self.night_hours = night_hours
+        self.weather = weather
+
+    def get_display(self):
+        return self.display
+
+    def get_night_hours(self):
+        return self.night_hours
+
+    def get_weather(self):
+        return self.weather
+
+    def serialize(self):
+        json_obj = self.display.serialize()
+        json_obj['night-hours'] = self.night_hours.serialize()
+        json_obj['weather'] = self.weather.serialize()
+        return json_obj
+
+    @classmethod
+    def deserialize(cls, json_obj):
+        return cls(
+            display=DisplayConfig.deserialize(json_obj),
+            night_hours=NightHoursConfig.deserialize(json_obj.get('night-hours', {})),
+            weather=WeatherConfig.deserialize(json_obj.get('weather', {}))
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as infil:
+            return cls.deserialize(json.load(infil))
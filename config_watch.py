@@ -0,0 +1,69 @@
+import os
+
+
+# Polls modification times rather than waiting on inotify, so it works the same everywhere; one stat per file per poll
+# is cheap enough to run from the frame loop's scheduler
+class FileWatcher(object):
+    def __init__(self, paths=None, directories=None):
+        if paths is None:
+            paths = []
+        if directories is None:
+            directories = []
+        self.paths = paths
+        # Every file in these is watched, including ones added or removed later
+        self.directories = directories
+        self.state = self._scan()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def _scan(self):
+        state = {path: self._stat(path) for path in self.paths}
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for fil in os.listdir(directory):
+                path = os.path.join(directory, fil)
+                state[path] = self._stat(path)
+        return state
+
+    def is_watched_directory(self, path):
+        return os.path.dirname(path) in self.directories
+
+    # Returns the paths added, removed or modified since the last poll
+    def poll(self):
+        state = self._scan()
+        changed = [path for path in set(state) | set(self.state) if state.get(path) != self.state.get(path)]
+        self.state = state
+        return sorted(changed)
+
+
+# What a config change invalidates, built off the render thread; anything left as None is kept as it is
+class PreparedReload(object):
+    def __init__(self, clock_config):
+        self.clock_config = clock_config
+        # Descriptions of what changed, for the log
+        self.changes = []
+        self.size_data = None
+        self.fonts = None
+        # Effect name to effect, for a new display size
+        self.effects = None
+        self.weather_cache = None
+        self.night_hours = None
+
+    def get_clock_config(self):
+        return self.clock_config
+
+    def get_changes(self):
+        return self.changes
+
+    def add_change(self, change):
+        self.changes.append(change)
+
+    def rebuilds_patterns(self):
+        return self.size_data is not None or self.fonts is not None
@@ -0,0 +1,328 @@
+import collections
+import copy
+import math
+import fps_tools
+import render_tools
+import memory_tools
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+# Rough per-frame cost of an effect, used to pick a cheaper effect on larger displays
+COST_LOOKUP = 0  # The frame is a precomputed image, nothing is computed per frame
+COST_PALETTE = 1  # The field is precomputed, only the palette is rotated and applied per frame
+COST_FIELD = 2  # The field itself is recomputed every frame before the palette is applied
+
+# The largest display (in modules) each cost class is allowed to run on; None means no limit
+cost_module_limits = {
+    COST_LOOKUP: None,
+    COST_PALETTE: None,
+    COST_FIELD: 4,
+}
+
+palette_size = 256
+
+
+def gen_palette(color_table):
+    # Resample the color table down (or up) to a flat 256 entry palette, as expected by putpalette
+    palette = []
+    for idx in range(palette_size):
+        palette.extend(color_table[int(idx * len(color_table) / palette_size)])
+    return palette
+
+
+def gen_sine_lut(periods=None, amplitude=None):
+    # Maps a 0-255 field value through `periods` full sine waves, scaled to 0-amplitude
+    if periods is None:
+        periods = 1
+    if amplitude is None:
+        amplitude = 255
+    return [int((math.sin(val / palette_size * periods * 2 * math.pi) + 1) / 2 * amplitude) for val in range(256)]
+
+
+def gen_ramp_image(image_size, horizontal, step):
+    # A field where every pixel is (x*step) or (y*step) modulo 256; one row/column is built and stretched out
+    length = image_size[0] if horizontal else image_size[1]
+    line = Image.new('L', (length, 1) if horizontal else (1, length))
+    line.putdata([int(idx * step) % 256 for idx in range(length)])
+    return line.resize(image_size, Image.NEAREST)
+
+
+# The same as ImageChops.offset(image, x_offset, y_offset).crop(box), without offsetting the whole image
+def crop_wrapped(image, box, x_offset, y_offset):
+    (width, height) = image.size
+    size = (box[2] - box[0], box[3] - box[1])
+    left = (box[0] - x_offset) % width
+    top = (box[1] - y_offset) % height
+    if left + size[0] <= width and top + size[1] <= height:
+        return image.crop((left, top, left + size[0], top + size[1]))
+    # The box wraps around an edge, so it's put together from the pieces on either side
+    tile = Image.new(image.mode, size)
+    y = 0
+    while y < size[1]:
+        src_top = (top + y) % height
+        rows = min(size[1] - y, height - src_top)
+        x = 0
+        while x < size[0]:
+            src_left = (left + x) % width
+            cols = min(size[0] - x, width - src_left)
+            tile.paste(image.crop((src_left, src_top, src_left + cols, src_top + rows)), (x, y))
+            x += cols
+        y += rows
+    return tile
+
+
+# Effects move on with advance and are drawn with render, or render_box for part of the display; frame does both.
+# render_box doesn't change the effect, so the boxes of one frame can be drawn on different threads
+class BackgroundEffect(object):
+    cost = COST_PALETTE
+
+    def __init__(self, image_size, color_table=None, d_dt=None):
+        if color_table is None:
+            color_table = render_tools.gen_color_table(saturation=80)
+        if d_dt is None:
+            d_dt = math.pi/3  # Roughly one palette rotation per 6s, same as the rainbow
+        self.image_size = image_size
+        self.palette = gen_palette(color_table)
+        self.palette_rotation = fps_tools.DTAwareRotation(d_dt=d_dt)
+        self.color_step = 1
+        self.indexed = self.gen_field()
+        self.indexed.putpalette(self.palette)
+
+    def gen_field(self):
+        return Image.new('L', self.image_size)
+
+    # Puts the effect back to a known point, e.g. for repeatable test frames
+    def reset(self, rotation):
+        self.palette_rotation.set_value(rotation)
+
+    # Coarser steps mean fewer distinct frames, which lets later stages skip more work
+    def set_color_step(self, color_step):
+        self.color_step = max(1, int(color_step))
+
+    def get_palette_offset(self):
+        offset = int(self.palette_rotation.get_rotation_degrees() / 360 * palette_size) % palette_size
+        return offset - offset % self.color_step
+
+    def get_rotated_palette(self):
+        offset = self.get_palette_offset() * 3
+        return self.palette[offset:] + self.palette[:offset]
+
+    # Identifies the image the next frame() will produce; None means it's different every frame
+    def get_frame_key(self):
+        return self.get_palette_offset()
+
+    # Everything precomputed for the effect: fields, layers and lookup tables
+    def get_image_bytes(self):
+        return memory_tools.count_image_bytes(vars(self))
+
+    # Gives back what it can to get under max_bytes; most effects have nothing they could make again
+    def shrink(self, max_bytes):
+        pass
+
+    # A copy with its own state, sharing only the precomputed images it never changes, for a renderer that may run
+    # alongside this one's (e.g. after a watchdog restart)
+    def clone(self):
+        effect = copy.copy(self)
+        effect.palette_rotation = copy.copy(self.palette_rotation)
+        effect.indexed = self.indexed.copy()
+        return effect
+
+    def advance(self, dt):
+        self.palette_rotation.dt(dt)
+
+    def render(self):
+        self.indexed.putpalette(self.get_rotated_palette())
+        return self.indexed.convert('RGB')
+
+    def render_box(self, box):
+        field = self.indexed.crop(box)
+        field.putpalette(self.get_rotated_palette())
+        return field.convert('RGB')
+
+    def frame(self, dt):
+        self.advance(dt)
+        return self.render()
+
+
+class RainbowEffect(BackgroundEffect):
+    cost = COST_LOOKUP
+    table_length = 360
+
+    def __init__(self, image_size, color_table=None, d_dt=None):
+        if color_table is None:
+            color_table = render_tools.gen_color_table(saturation=80)
+        if d_dt is None:
+            d_dt = math.pi/3
+        self.image_size = image_size
+        self.color_table = color_table
+        self.palette_rotation = fps_tools.DTAwareRotation(d_dt=d_dt)
+        self.color_step = 1
+        # One image per degree, made the first time it's needed. Under a memory budget only table_limit of them are
+        # kept, the oldest being dropped (and made again next time round) to make room
+        self.rainbow_image_table = [None] * self.table_length
+        self.table_order = collections.deque()
+        self.table_limit = None
+
+    def get_frame_key(self):
+        rotation = int(self.palette_rotation.get_rotation_degrees()) % self.table_length
+        return rotation - rotation % self.color_step
+
+    def get_table_image(self, rotation):
+        if self.rainbow_image_table[rotation] is None:
+            if self.table_limit is not None:
+                self.drop_table_images(self.table_limit - 1)
+            self.rainbow_image_table[rotation] = render_tools.gen_rainbow_image(rotation, self.color_table,
+                                                                                self.image_size)
+            self.table_order.append(rotation)
+        return self.rainbow_image_table[rotation]
+
+    def drop_table_images(self, keep):
+        while len(self.table_order) > max(keep, 0):
+            self.rainbow_image_table[self.table_order.popleft()] = None
+
+    def clone(self):
+        effect = copy.copy(self)
+        effect.palette_rotation = copy.copy(self.palette_rotation)
+        effect.rainbow_image_table = list(self.rainbow_image_table)
+        effect.table_order = collections.deque(self.table_order)
+        return effect
+
+    def shrink(self, max_bytes):
+        table_image_bytes = self.image_size[0] * self.image_size[1] * memory_tools.image_mode_bytes['RGB']
+        self.table_limit = max(1, int(max_bytes / table_image_bytes))
+        self.drop_table_images(self.table_limit)
+
+    def advance(self, dt):
+        super().advance(dt)
+        # Made here, on the render thread, so render_box never has to
+        self.get_table_image(self.get_frame_key())
+
+    def render(self):
+        return self.get_table_image(self.get_frame_key())
+
+    def render_box(self, box):
+        return self.render().crop(box)
+
+
+class WaveEffect(BackgroundEffect):
+    # Slow diagonal bands of color drifting across the display
+    def gen_field(self):
+        return ImageChops.add_modulo(
+            gen_ramp_image(self.image_size, True, 2),
+            gen_ramp_image(self.image_size, False, 3)
+        )
+
+
+class RadialEffect(BackgroundEffect):
+    # Rings of color moving out from the middle of the display
+    rings = 3
+
+    def gen_field(self):
+        # radial_gradient is 256x256, 0 in the middle, 255 at the corners
+        gradient = Image.radial_gradient('L').resize(self.image_size, Image.BILINEAR)
+        return gradient.point([(val * self.rings) % 256 for val in range(256)])
+
+
+class NoiseEffect(BackgroundEffect):
+    # Smooth blobs of color; generated small and scaled up so the field stays soft
+    scale = 8
+
+    def gen_field(self):
+        small_size = (max(2, int(self.image_size[0] / self.scale)), max(2, int(self.image_size[1] / self.scale)))
+        noise = Image.effect_noise(small_size, 64).filter(ImageFilter.GaussianBlur(1))
+        return ImageOps.autocontrast(noise.resize(self.image_size, Image.BICUBIC))
+
+
+class PlasmaEffect(BackgroundEffect):
+    cost = COST_FIELD
+
+    def __init__(self, image_size, color_table=None, d_dt=None):
+        # Each layer is a third of the range so the sum never clips
+        layer_lut = gen_sine_lut(amplitude=85)
+        self.x_layer = gen_ramp_image(image_size, True, palette_size / image_size[0]).point(layer_lut)
+        self.y_layer = gen_ramp_image(image_size, False, palette_size / image_size[1]).point(layer_lut)
+        self.radial_layer = Image.radial_gradient('L').resize(image_size, Image.BILINEAR).point(
+            gen_sine_lut(periods=2, amplitude=85))
+        # Units are increments of pi per second; the layers slide at different rates so the plasma churns
+        self.x_motion = fps_tools.DTAwareRotation(d_dt=math.pi/4)
+        self.y_motion = fps_tools.DTAwareRotation(d_dt=math.pi/7)
+        super().__init__(image_size, color_table=color_table, d_dt=d_dt)
+
+    def get_shifts(self):
+        x_shift = int(self.x_motion.get_rotation_degrees() / 360 * self.image_size[0])
+        y_shift = int(self.y_motion.get_rotation_degrees() / 360 * self.image_size[1])
+        return (x_shift, y_shift)
+
+    def gen_field(self):
+        (x_shift, y_shift) = self.get_shifts()
+        return ImageChops.add(
+            ImageChops.add(ImageChops.offset(self.x_layer, x_shift, 0), ImageChops.offset(self.y_layer, 0, y_shift)),
+            self.radial_layer
+        )
+
+    def gen_field_box(self, box):
+        (x_shift, y_shift) = self.get_shifts()
+        return ImageChops.add(
+            ImageChops.add(crop_wrapped(self.x_layer, box, x_shift, 0), crop_wrapped(self.y_layer, box, 0, y_shift)),
+            self.radial_layer.crop(box)
+        )
+
+    def clone(self):
+        effect = super().clone()
+        effect.x_motion = copy.copy(self.x_motion)
+        effect.y_motion = copy.copy(self.y_motion)
+        return effect
+
+    def reset(self, rotation):
+        super().reset(rotation)
+        self.x_motion.set_value(rotation)
+        self.y_motion.set_value(rotation)
+
+    def get_frame_key(self):
+        return None
+
+    def advance(self, dt):
+        self.x_motion.dt(dt)
+        self.y_motion.dt(dt)
+        self.palette_rotation.dt(dt)
+
+    def render(self):
+        field = self.gen_field()
+        field.putpalette(self.get_rotated_palette())
+        return field.convert('RGB')
+
+    def render_box(self, box):
+        field = self.gen_field_box(box)
+        field.putpalette(self.get_rotated_palette())
+        return field.convert('RGB')
+
+
+effect_types = {
+    'rainbow': RainbowEffect,
+    'waves': WaveEffect,
+    'radial': RadialEffect,
+    'noise': NoiseEffect,
+    'plasma': PlasmaEffect,
+}
+# Used when the requested effect is too expensive for the display
+fallback_effect = 'waves'
+
+
+def max_cost_for_size(size_data):
+    modules = size_data.get_width() * size_data.get_height()
+    allowed = COST_LOOKUP
+    for cost, module_limit in cost_module_limits.items():
+        if module_limit is None or modules <= module_limit:
+            allowed = max(allowed, cost)
+    return allowed
+
+
+def create_effect(name, size_data, color_table=None):
+    effect_type = effect_types.get(name)
+    if effect_type is None:
+        raise ValueError('Unknown background effect {:s}, expected one of {:s}'.format(
+            str(name), ', '.join(effect_types.keys())))
+    if effect_type.cost > max_cost_for_size(size_data):
+        print('Background effect {:s} is too expensive for a {:d}x{:d} display, using {:s}'.format(
+            name, size_data.get_width(), size_data.get_height(), fallback_effect))
+        effect_type = effect_types[fallback_effect]
+    return effect_type(size_data.get_image_size(), color_table=color_table)
@@ -1,3 +1,4 @@
+import datetime
 import time
 import math
 
@@ -14,6 +15,9 @@ class DTAwareValue(object):
     def dt(self, dt):
         self.value += self.d_dt * dt
 
+    def set_value(self, value):
+        self.value = value
+
 
 class DTAwarePeriodicValue(DTAwareValue):
     def __init__(self, d_dt=None, start_value=None, limit=None, reset_func=None):
@@ -31,6 +35,40 @@ class DTAwarePeriodicValue(DTAwareValue):
                 self.reset_func()
 
 
+class DTAwareRamp(DTAwareValue):
+    # Moves towards a target value at d_dt units per second, then holds there
+    def __init__(self, d_dt=None, start_value=None):
+        super().__init__(d_dt=d_dt, start_value=start_value)
+        self.target = self.value
+
+    def set_target(self, target, d_dt=None):
+        self.target = target
+        if d_dt is not None:
+            self.d_dt = d_dt
+
+    def set_value(self, value):
+        self.value = value
+        self.target = value
+
+    def dt(self, dt):
+        step = self.d_dt * dt
+        if abs(self.target - self.value) <= step:
+            self.value = self.target
+        elif self.target > self.value:
+            self.value += step
+        else:
+            self.value -= step
+
+    def get_value(self):
+        return self.value
+
+    def get_target(self):
+        return self.target
+
+    def is_ramping(self):
+        return self.value != self.target
+
+
 class DTAwareObjectRotation(DTAwarePeriodicValue):
     def __init__(self, d_dt=None, start_value=None, limit=None, choices=None, initial_choice=None):
         super().__init__(d_dt=d_dt, start_value=start_value, limit=limit, reset_func=self.rotate_object)
@@ -68,10 +106,61 @@ class DTAwareRotation(DTAwarePeriodicValue):
         return self.value / self.__twopi * 360
 
 
+class RealTimeSource(object):
+    def __init__(self, tz=None):
+        self.tz = tz
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self):
+        return datetime.datetime.now(self.tz)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+# Stands in for the real clock so a day of behaviour can be run in minutes. With a speed, virtual time runs that many
+# times faster than real time; without one, it only moves when something sleeps, so frames run as fast as possible
+class VirtualTimeSource(object):
+    def __init__(self, start, speed=None):
+        self.start = start.timestamp()
+        self.tz = start.tzinfo
+        self.speed = speed if speed is not None and speed > 0 else None
+        self.elapsed = 0.0
+        self.real_start = time.monotonic()
+
+    def get_elapsed(self):
+        if self.speed is None:
+            return self.elapsed
+        return (time.monotonic() - self.real_start) * self.speed
+
+    def time(self):
+        return self.start + self.get_elapsed()
+
+    def monotonic(self):
+        return self.get_elapsed()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time(), self.tz)
+
+    def sleep(self, seconds):
+        if self.speed is None:
+            self.elapsed += seconds
+        else:
+            time.sleep(seconds / self.speed)
+
+
 class FPSClock(object):
-    def __init__(self, target_fps=None):
+    def __init__(self, target_fps=None, time_func=None):
         if target_fps is None:
             target_fps = 60
+        if time_func is None:
+            time_func = time.time
+        self.time_func = time_func
         self.target_fps = target_fps
         self.dt_target = 1/self.target_fps
         self.pre_frame = None
@@ -79,31 +168,47 @@ class FPSClock(object):
         self.post_frame = None
         self.dt = 0
         self.dt_render = 0
+        # Always real time, even when frames are on a virtual clock, so a watchdog can tell a stalled loop from a slow one
+        self.heartbeat = time.monotonic()
 
     # Start a new frame
     def start_frame(self):
         if self.post_frame is not None and self.pre_frame is not None:
             self.dt = self.post_frame - self.pre_frame
-        self.pre_frame = time.time()
+        self.pre_frame = self.time_func()
+        self.heartbeat = time.monotonic()
 
     # Indicate that all work is finished, and we are ready to sleep
     def finish_render(self):
-        self.post_render = time.time()
+        self.post_render = self.time_func()
         if self.pre_frame is not None:
             self.dt_render = self.post_render - self.pre_frame
+        self.heartbeat = time.monotonic()
 
     # Indicate that we have finished with this frame entirely
     def finish_frame(self):
-        self.post_frame = time.time()
+        self.post_frame = self.time_func()
+        self.heartbeat = time.monotonic()
 
     def get_dt(self):
         return self.dt
 
+    def set_target_fps(self, target_fps):
+        self.target_fps = target_fps
+        self.dt_target = 1/self.target_fps
+
+    def get_target_fps(self):
+        return self.target_fps
+
     def get_dt_target(self):
         return self.dt_target
 
     def get_sleep_time(self):
         return self.dt_target - self.dt_render
 
+    # time.monotonic() of the last start, finish_render or finish_frame
+    def get_heartbeat(self):
+        return self.heartbeat
+
     def get_last_render_time(self):
         return self.dt_render
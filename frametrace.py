@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Header: magic, format version, record size, capacity (records), records written in total
+trace_header_format = '<8sIIQQ'
+trace_header_size = struct.calcsize(trace_header_format)
+trace_magic = b'CLKTRACE'
+trace_version = 1
+# Frame index, start (time.monotonic_ns), then microseconds from the start until the frame was rendered, handed to
+# the matrix and finished (after its sleep); pattern, font and quality ids; text cache hits and misses; flags
+record_format = '<QQIIIHHHHHBx'
+record_size = struct.calcsize(record_format)
+# The frame took longer than its budget
+FLAG_DROPPED = 1
+# The first frame this writer wrote, so the gap from the frame before it (from an earlier run) isn't a frame interval
+FLAG_FIRST = 2
+# Roughly 5 hours at 60fps in 40MiB; a week at 60fps needs about 36 million, 1.4GiB (see capacity_for_hours)
+default_capacity = 1 << 20
+name_kinds = ('patterns', 'fonts', 'quality')
+# Where the total record count sits in the header, so it can be updated on its own
+count_offset = struct.calcsize('<8sIIQ')
+max_us = (1 << 32) - 1
+max_count = (1 << 16) - 1
+
+
+# Records needed to hold `hours` of frames
+def capacity_for_hours(hours, fps=None):
+    if fps is None:
+        fps = 60
+    return max(1, int(hours * 3600 * fps))
+
+
+def names_path(path):
+    return path + '.names.json'
+
+
+# Appends fixed size records to a memory mapped ring file; once it's full the oldest frames are overwritten. Names
+# are stored as small ids, with the names themselves in a JSON file alongside, which only changes for a new name
+class FrameTraceWriter(object):
+    def __init__(self, path, capacity=None):
+        if capacity is None:
+            capacity = default_capacity
+        self.path = path
+        self.capacity = capacity
+        self.names = {kind: [] for kind in name_kinds}
+        self.ids = {kind: {} for kind in name_kinds}
+        size = trace_header_size + capacity * record_size
+        resume = False
+        if os.path.isfile(path) and os.path.getsize(path) == size:
+            with open(path, 'rb') as infil:
+                (magic, version, size_check, capacity_check, _) = struct.unpack(
+                    trace_header_format, infil.read(trace_header_size))
+            resume = (magic, version, size_check, capacity_check) == (trace_magic, trace_version, record_size, capacity)
+        self.fil = open(path, 'r+b' if resume else 'w+b')
+        if not resume:
+            self.fil.truncate(size)
+        self.map = mmap.mmap(self.fil.fileno(), size)
+        if resume:
+            self.count = struct.unpack_from(trace_header_format, self.map, 0)[4]
+            self._load_names()
+        else:
+            self.count = 0
+            struct.pack_into(trace_header_format, self.map, 0, trace_magic, trace_version, record_size, capacity, 0)
+            self._save_names()
+        self.first_count = self.count
+        # A renderer that takes over (e.g. after a watchdog restart) carries on writing to the same trace; only the
+        # current owner's frames are written, so one that was stalled can't write over them when it wakes up
+        self.lock = threading.Lock()
+        self.owner = None
+
+    def _load_names(self):
+        try:
+            with open(names_path(self.path), 'r') as infil:
+                saved = json.load(infil)
+            for kind in name_kinds:
+                self.names[kind] = list(saved.get(kind, []))
+                self.ids[kind] = {name: name_id for (name_id, name) in enumerate(self.names[kind])}
+        except Exception as e:
+            print('Unable to load trace names from {:s}: {:s}'.format(names_path(self.path), str(e)))
+
+    def _save_names(self):
+        temp_path = names_path(self.path) + '.tmp'
+        with open(temp_path, 'w') as outfil:
+            json.dump(self.names, outfil)
+        os.replace(temp_path, names_path(self.path))
+
+    def get_id(self, kind, name):
+        name_id = self.ids[kind].get(name)
+        if name_id is None:
+            name_id = len(self.names[kind])
+            self.names[kind].append(name)
+            self.ids[kind][name] = name_id
+            self._save_names()
+        return name_id
+
+    def set_owner(self, owner):
+        with self.lock:
+            self.owner = owner
+
+    def write(self, start_ns, rendered_ns, presented_ns, end_ns, pattern, font, quality_name, hits, misses, dropped,
+              owner=None):
+        with self.lock:
+            if owner is not self.owner:
+                return
+            self._write(start_ns, rendered_ns, presented_ns, end_ns, pattern, font, quality_name, hits, misses, dropped)
+
+    def _write(self, start_ns, rendered_ns, presented_ns, end_ns, pattern, font, quality_name, hits, misses, dropped):
+        offset = trace_header_size + (self.count % self.capacity) * record_size
+        struct.pack_into(record_format, self.map, offset, self.count, start_ns,
+                         min(max_us, (rendered_ns - start_ns) // 1000),
+                         min(max_us, (presented_ns - start_ns) // 1000),
+                         min(max_us, (end_ns - start_ns) // 1000),
+                         self.get_id('patterns', pattern), self.get_id('fonts', font),
+                         self.get_id('quality', quality_name), min(max_count, hits), min(max_count, misses),
+                         (FLAG_DROPPED if dropped else 0) | (FLAG_FIRST if self.count == self.first_count else 0))
+        self.count += 1
+        struct.pack_into('<Q', self.map, count_offset, self.count)
+
+    def get_count(self):
+        return self.count
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.fil.close()
+
+
+# Where each field sits in a record tuple
+(REC_INDEX, REC_START, REC_RENDER, REC_PRESENT, REC_FRAME, REC_PATTERN, REC_FONT, REC_QUALITY, REC_HITS, REC_MISSES,
+ REC_FLAGS) = range(11)
+
+
+def read_header(infil, path):
+    (magic, version, size_check, capacity, count) = struct.unpack(trace_header_format, infil.read(trace_header_size))
+    if magic != trace_magic or version != trace_version or size_check != record_size:
+        raise ValueError('{:s} is not a version {:d} frame trace'.format(path, trace_version))
+    return (capacity, count)
+
+
+def read_names(path):
+    names = {kind: [] for kind in name_kinds}
+    if os.path.isfile(names_path(path)):
+        with open(names_path(path), 'r') as infil:
+            names.update(json.load(infil))
+    return names
+
+
+def get_name(names, kind, name_id):
+    return names[kind][name_id] if name_id < len(names[kind]) else str(name_id)
+
+
+# Every record still in the ring, oldest first, as tuples in record_format order. They're unpacked straight out of a
+# memory map as they're asked for, so even a week of frames is never in memory all at once
+def iter_trace(path):
+    with open(path, 'rb') as infil:
+        (capacity, count) = read_header(infil, path)
+        if count == 0:
+            return
+        with mmap.mmap(infil.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                stored = min(count, capacity)
+                wrap = count % capacity if count > capacity else 0
+                for (first, last) in ((wrap, stored), (0, wrap)):
+                    segment = view[trace_header_size + first * record_size:trace_header_size + last * record_size]
+                    try:
+                        yield from struct.iter_unpack(record_format, segment)
+                    finally:
+                        segment.release()
+            finally:
+                view.release()
+
+
+# The newest record, without reading the rest
+def read_last_record(path):
+    with open(path, 'rb') as infil:
+        (capacity, count) = read_header(infil, path)
+        if count == 0:
+            return None
+        infil.seek(trace_header_size + ((count - 1) % capacity) * record_size)
+        return struct.unpack(record_format, infil.read(record_size))
+
+
+# How often each value came up, which is all a percentile needs; frame times repeat a lot, so this stays small however
+# many frames go into it
+class Distribution(object):
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+
+    def add(self, value):
+        self.counts[value] += 1
+        self.total += 1
+
+    def get_total(self):
+        return self.total
+
+    # The same as quality.percentile over every value added
+    def percentile(self, fraction):
+        target = min(self.total - 1, int(fraction * self.total))
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen > target:
+                return value
+
+    def get_max(self):
+        return max(self.counts)
+
+    def get_mean(self):
+        return sum(value * count for value, count in self.counts.items()) / self.total
+
+    def get_std_dev(self):
+        mean = self.get_mean()
+        return (sum((value - mean) ** 2 * count for value, count in self.counts.items()) / self.total) ** 0.5
+
+
+def format_percentiles(distribution):
+    if distribution.get_total() == 0:
+        return 'no frames'
+    return 'p50 {:.2f} p90 {:.2f} p99 {:.2f} p99.9 {:.2f} max {:.2f}ms'.format(
+        *[distribution.percentile(fraction) / 1000 for fraction in (0.5, 0.9, 0.99, 0.999)],
+        distribution.get_max() / 1000)
+
+
+# Goes over the records once, keeping counts rather than the records themselves
+def summarize(records, names, worst=None, after_change=None):
+    if worst is None:
+        worst = 10
+    if after_change is None:
+        after_change = 3  # Frames after a font or pattern change that are put down to the change
+    render_times = Distribution()
+    present_times = Distribution()
+    intervals = Distribution()
+    changed_times = Distribution()
+    steady_times = Distribution()
+    groups = {'pattern': {}, 'font': {}, 'quality': {}}
+    # Smallest first, so the least bad of the worst frames is the one pushed out
+    worst_frames = []
+    (dropped, hits, misses) = (0, 0, 0)
+    (first, prev) = (None, None)
+    since_change = None
+    for (seq, record) in enumerate(records):
+        if first is None:
+            first = record
+        render_us = record[REC_RENDER]
+        render_times.add(render_us)
+        present_times.add(record[REC_PRESENT] - render_us)
+        # The gap to a new run isn't a frame interval
+        if prev is not None and not record[REC_FLAGS] & FLAG_FIRST:
+            intervals.add((record[REC_START] - prev[REC_START]) // 1000)
+        if record[REC_FLAGS] & FLAG_DROPPED:
+            dropped += 1
+        hits += record[REC_HITS]
+        misses += record[REC_MISSES]
+
+        # Which frames came soon after the font or pattern changed
+        if prev is not None and (record[REC_FONT] != prev[REC_FONT] or record[REC_PATTERN] != prev[REC_PATTERN]):
+            since_change = 0
+        elif since_change is not None:
+            since_change += 1
+        changed = since_change is not None and since_change < after_change
+        (changed_times if changed else steady_times).add(render_us)
+        for (label, field) in (('pattern', REC_PATTERN), ('font', REC_FONT), ('quality', REC_QUALITY)):
+            group = groups[label]
+            if record[field] not in group:
+                group[record[field]] = Distribution()
+            group[record[field]].add(render_us)
+
+        entry = (render_us, seq, record, changed)
+        if len(worst_frames) < worst:
+            heapq.heappush(worst_frames, entry)
+        elif worst > 0 and entry[:2] > worst_frames[0][:2]:
+            heapq.heapreplace(worst_frames, entry)
+        prev = record
+
+    if first is None:
+        print('No frames recorded')
+        return
+    frames = render_times.get_total()
+    span = (prev[REC_START] - first[REC_START]) / 1e9
+    print('{:d} frames over {:.1f}s, frames {:d} to {:d}'.format(frames, span, first[REC_INDEX], prev[REC_INDEX]))
+    print('Render   {:s}'.format(format_percentiles(render_times)))
+    print('Present  {:s}'.format(format_percentiles(present_times)))
+    print('Interval {:s}'.format(format_percentiles(intervals)))
+    if intervals.get_total() > 1:
+        print('Jitter {:.2f}ms (std dev of the interval), p99-p50 {:.2f}ms'.format(
+            intervals.get_std_dev() / 1000, (intervals.percentile(0.99) - intervals.percentile(0.5)) / 1000))
+    print('Dropped {:d} ({:.2f}%)'.format(dropped, 100 * dropped / frames))
+    print('Text cache {:d} hits, {:d} misses ({:.1f}% hit rate)'.format(
+        hits, misses, 100 * hits / (hits + misses) if hits + misses > 0 else 0))
+
+    print('Within {:d} frames of a font/pattern change ({:d} frames): {:s}'.format(
+        after_change, changed_times.get_total(), format_percentiles(changed_times)))
+    print('Otherwise ({:d} frames): {:s}'.format(steady_times.get_total(), format_percentiles(steady_times)))
+    for (label, kind) in (('pattern', 'patterns'), ('font', 'fonts'), ('quality', 'quality')):
+        named = sorted((get_name(names, kind, name_id), times) for name_id, times in groups[label].items())
+        for name, times in named:
+            print('  {:s} {:s} ({:d} frames): {:s}'.format(label, name, times.get_total(), format_percentiles(times)))
+
+    print('Worst {:d} frames by render time:'.format(min(worst, frames)))
+    # Ties go to the earlier frame, as a stable sort would
+    for (render_us, seq, record, changed) in sorted(worst_frames, key=lambda entry: (-entry[0], entry[1])):
+        context = []
+        if changed:
+            context.append('after a font/pattern change')
+        if record[REC_MISSES] > 0:
+            context.append('{:d} text cache misses'.format(record[REC_MISSES]))
+        if record[REC_FLAGS] & FLAG_DROPPED:
+            context.append('dropped')
+        print('  frame {:d} at {:.3f}s: render {:.2f}ms frame {:.2f}ms, {:s} / {:s} / {:s}{:s}'.format(
+            record[REC_INDEX], (record[REC_START] - first[REC_START]) / 1e9, render_us / 1000,
+            record[REC_FRAME] / 1000, get_name(names, 'patterns', record[REC_PATTERN]),
+            get_name(names, 'fonts', record[REC_FONT]), get_name(names, 'quality', record[REC_QUALITY]),
+            '' if len(context) == 0 else ' ({:s})'.format(', '.join(context))))
+
+
+def run_analyzer():
+    parser = argparse.ArgumentParser(description='Summarize a frame trace recorded with clock.py --trace')
+    parser.add_argument('trace', help='Trace file')
+    parser.add_argument('--worst', type=int, default=10, help='Number of worst frames to list')
+    parser.add_argument('--after-change', type=int, default=3,
+                        help='Frames after a font or pattern change that count as affected by it')
+    parser.add_argument('--last', type=float, default=None, help='Only look at the last this many seconds')
+    args = parser.parse_args()
+
+    pre_read = time.perf_counter()
+    records = iter_trace(args.trace)
+    if args.last is not None:
+        last_record = read_last_record(args.trace)
+        if last_record is not None:
+            cutoff = last_record[REC_START] - int(args.last * 1e9)
+            records = (record for record in records if record[REC_START] >= cutoff)
+    summarize(records, read_names(args.trace), worst=args.worst, after_change=args.after_change)
+    print('Read {:s} in {:.2f}s'.format(args.trace, time.perf_counter() - pre_read))
+
+
+if __name__ == '__main__':
+    run_analyzer()
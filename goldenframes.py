@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+import clock
+import config
+import fps_tools
+import scheduler
+import weather
+import clock_pattern
+import weather_pattern
+from PIL import Image, ImageChops, features
+import PIL
+
+golden_sizes = [(1, 1), (2, 1), (2, 2)]
+golden_times = ['00:00:00', '09:05:07', '12:34:56', '23:59:59']
+golden_angles = [0, 90, 180, 270]
+# Effects that are fully determined by their rotation; noise is random, so it can't have a golden frame
+golden_effects = ['rainbow', 'waves', 'radial', 'plasma']
+# The weather legend can be filled with an effect too; one is enough to cover it
+golden_weather_effects = ['rainbow']
+golden_date = datetime.date(2023, 5, 15)
+# Other dates, each at one time; January's J hangs left of where it's drawn, which the text measuring has to allow for
+golden_extra_moments = [(datetime.date(2024, 1, 19), '07:08:09')]
+golden_tz = datetime.timezone(datetime.timedelta(hours=-4))
+
+
+def hash_frame(image):
+    return hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+
+
+class StubWeatherCache(object):
+    # Made up forecast, hourly for two days, in the same shape as the forecastGridData response. With `gaps`, every
+    # third hour has no temperature, as the service sometimes sends
+    def __init__(self, now, gaps=None):
+        if gaps is None:
+            gaps = False
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        series = {'probabilityOfPrecipitation': [], 'temperature': [], 'relativeHumidity': []}
+        for hour in range(48):
+            valid_time = (start + datetime.timedelta(hours=hour)).isoformat() + '/PT1H'
+            temperature = 15 + 12 * ((hour % 24) - abs((hour % 24) - 14)) / 14
+            if gaps and hour % 3 == 0:
+                temperature = None
+            series['temperature'].append({'validTime': valid_time, 'value': temperature})
+            series['relativeHumidity'].append({'validTime': valid_time, 'value': 40 + hour % 30})
+            series['probabilityOfPrecipitation'].append({'validTime': valid_time, 'value': (hour * 7) % 100})
+        weather_data = {key: {'values': values} for key, values in series.items()}
+        weather_data['updateTime'] = start.isoformat()
+        self.prediction = weather.WeatherPredictionData(weather_data, golden_tz, now=now)
+
+    def get_current_prediction(self):
+        return self.prediction
+
+
+def make_function_data(size_data, now):
+    time_source = fps_tools.VirtualTimeSource(now, speed=0)
+    night_clock = clock.NightClock()
+    night_clock.update_time(now)
+    function_data = clock.FunctionData(night_clock, fps_tools.FPSClock(time_func=time_source.time),
+                                       scheduler.EventScheduler(time_func=time_source.monotonic), size_data,
+                                       {'single': True}, time_source=time_source)
+    function_data.set_now(now)
+    return function_data
+
+
+def golden_now(time_str, date=None):
+    if date is None:
+        date = golden_date
+    parsed = datetime.datetime.strptime(time_str, '%H:%M:%S').time()
+    return datetime.datetime.combine(date, parsed, tzinfo=golden_tz)
+
+
+def gen_moments():
+    for time_str in golden_times:
+        yield (None, time_str)
+    for (date, time_str) in golden_extra_moments:
+        yield (date, time_str)
+
+
+def moment_name(date, time_str):
+    name = time_str.replace(':', '')
+    if date is not None:
+        name = '{:s}-{:s}'.format(date.strftime('%Y%m%d'), name)
+    return name
+
+
+# What the frames depend on besides this code; a baseline only holds for the environment it was recorded in
+def get_environment(fonts):
+    font_digests = {}
+    for name, font in sorted(fonts.items()):
+        with open(font.get_pil_font().path, 'rb') as infil:
+            font_digests[name] = hashlib.sha256(infil.read()).hexdigest()
+    return {
+        'pillow': PIL.__version__,
+        'freetype': features.version('freetype2'),
+        'fonts': font_digests,
+    }
+
+
+# Yields (case name, pattern, setup function); setup puts the pattern back into the case's starting state
+def gen_cases(fonts):
+    for (width, height) in golden_sizes:
+        size_data = config.DisplayConfig(width=width, height=height)
+        function_data = make_function_data(size_data, golden_now(golden_times[0]))
+        for effect in golden_effects:
+            pattern = clock_pattern.ClockPattern(function_data, fonts, day_effect=effect)
+            for font_name in sorted(fonts.keys()):
+                for (date, time_str) in gen_moments():
+                    for angle in golden_angles:
+                        for inverted in (False, True):
+                            def setup(pattern=pattern, font_name=font_name, date=date, time_str=time_str,
+                                      angle=angle, inverted=inverted):
+                                function_data.set_now(golden_now(time_str, date=date))
+                                pattern.reset(angle / 180 * math.pi, font=fonts[font_name], inverted=inverted)
+                            name = 'clock-{:d}x{:d}-{:s}-{:s}-{:s}-{:d}{:s}'.format(
+                                width, height, effect, font_name.replace(' ', '_'), moment_name(date, time_str),
+                                angle, '-inverted' if inverted else '')
+                            yield name, pattern, setup
+        for (date, time_str) in gen_moments():
+            now = golden_now(time_str, date=date)
+            weather_function_data = make_function_data(size_data, now)
+            pattern = weather_pattern.WeatherPattern(weather_function_data, fonts, weather_cache=StubWeatherCache(now))
+            name = 'weather-{:d}x{:d}-{:s}'.format(width, height, moment_name(date, time_str))
+            yield name, pattern, lambda: None
+            for effect in golden_weather_effects:
+                pattern = weather_pattern.WeatherPattern(weather_function_data, fonts,
+                                                         weather_cache=StubWeatherCache(now), day_effect=effect)
+                name = 'weather-{:d}x{:d}-{:s}-{:s}'.format(width, height, effect, moment_name(date, time_str))
+                yield name, pattern, lambda pattern=pattern: pattern.reset(0)
+            pattern = weather_pattern.WeatherPattern(weather_function_data, fonts,
+                                                     weather_cache=StubWeatherCache(now, gaps=True))
+            name = 'weather-{:d}x{:d}-gaps-{:s}'.format(width, height, moment_name(date, time_str))
+            yield name, pattern, lambda: None
+            # The clock with the temperature badge over it, which is hidden for the hours without one
+            clock_pat = clock_pattern.ClockPattern(weather_function_data, fonts,
+                                                   overlays=[pattern.create_temperature_badge()])
+            name = 'clock-badge-{:d}x{:d}-gaps-{:s}'.format(width, height, moment_name(date, time_str))
+
+            def setup(pattern=pattern, clock_pat=clock_pat):
+                pattern.frame(0)
+                clock_pat.reset(0, font=fonts[sorted(fonts.keys())[0]], inverted=False)
+            yield name, clock_pat, setup
+
+
+def render_case(pattern, setup, sequence_frames):
+    setup()
+    first = pattern.frame(0)
+    first_hash = hash_frame(first)
+    sequence_hash = hashlib.blake2b(digest_size=16)
+    for _ in range(sequence_frames):
+        sequence_hash.update(hash_frame(pattern.frame(1/60)).encode('ascii'))
+    return first, first_hash, sequence_hash.hexdigest()
+
+
+def describe_diff(expected, actual):
+    if expected.size != actual.size:
+        return 'size {:s} != {:s}'.format(str(expected.size), str(actual.size))
+    diff = ImageChops.difference(expected.convert('RGB'), actual.convert('RGB'))
+    bbox = diff.getbbox()
+    changed = diff.convert('L').point(lambda v: 255 if v else 0).histogram()[255]
+    max_delta = max(band_max for (_, band_max) in diff.getextrema())
+    return '{:d} pixels differ (max channel delta {:d}) within {:s}'.format(changed, max_delta, str(bbox))
+
+
+def save_failure(failure_dir, name, expected, actual):
+    os.makedirs(failure_dir, exist_ok=True)
+    actual.save(os.path.join(failure_dir, '{:s}-actual.png'.format(name)))
+    if expected is not None and expected.size == actual.size:
+        expected.save(os.path.join(failure_dir, '{:s}-expected.png'.format(name)))
+        # Any difference at all shows up bright
+        diff = ImageChops.difference(expected.convert('RGB'), actual.convert('RGB')).point(lambda v: 255 if v else 0)
+        diff.save(os.path.join(failure_dir, '{:s}-diff.png'.format(name)))
+
+
+def run_golden():
+    containing_dir = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description='Render fixed frames and compare them with stored golden frames')
+    parser.add_argument('action', choices=['record', 'check'])
+    parser.add_argument('--golden-dir', default=os.path.join(containing_dir, 'golden'))
+    parser.add_argument('--failure-dir', default=os.path.join(containing_dir, 'golden_failures'))
+    parser.add_argument('--sequence-frames', type=int, default=60,
+                        help='Frames to render and hash after each golden frame, checked as one sequence hash')
+    parser.add_argument('--filter', default=None, help='Only run cases containing this string')
+    args = parser.parse_args()
+
+    random.seed(0)
+    golden_file = os.path.join(args.golden_dir, 'frames.json')
+    fonts = clock.find_fonts(containing_dir, 16)
+    environment = get_environment(fonts)
+    baseline = {'environment': None, 'frames': {}}
+    if os.path.isfile(golden_file):
+        with open(golden_file, 'r') as infil:
+            baseline = json.load(infil)
+    elif args.action == 'check':
+        print('No golden frames in {:s}, record them first'.format(golden_file))
+        return 1
+    golden = baseline['frames']
+    # Pillow and FreeType versions and the font files all change the pixels, without anything here being wrong
+    environment_changes = []
+    if args.action == 'check' and baseline['environment'] != environment:
+        recorded_environment = baseline['environment'] if baseline['environment'] is not None else {}
+        for key in sorted(environment.keys()):
+            if recorded_environment.get(key) != environment[key]:
+                environment_changes.append('{:s}: recorded with {:s}, running {:s}'.format(
+                    key, str(recorded_environment.get(key)), str(environment[key])))
+        for change in environment_changes:
+            print('Environment differs from the golden frames, {:s}'.format(change))
+    # Recording only some cases keeps the rest of the baseline
+    recorded = dict(golden) if args.filter is not None else {}
+    failures = []
+    frames = 0
+    hash_time = 0
+    pre_run = time.perf_counter()
+    for name, pattern, setup in gen_cases(fonts):
+        if args.filter is not None and args.filter not in name:
+            continue
+        pre_hash = time.perf_counter()
+        (first, first_hash, sequence_hash) = render_case(pattern, setup, args.sequence_frames)
+        hash_time += time.perf_counter() - pre_hash
+        frames += 1 + args.sequence_frames
+        entry = {'hash': first_hash, 'sequence': sequence_hash, 'sequence-frames': args.sequence_frames}
+        if args.action == 'record':
+            recorded[name] = entry
+            os.makedirs(args.golden_dir, exist_ok=True)
+            first.save(os.path.join(args.golden_dir, '{:s}.png'.format(name)))
+            continue
+        expected = golden.get(name)
+        if expected is None:
+            failures.append('{:s}: no golden frame recorded'.format(name))
+            continue
+        if expected['hash'] != first_hash:
+            expected_path = os.path.join(args.golden_dir, '{:s}.png'.format(name))
+            expected_image = Image.open(expected_path) if os.path.isfile(expected_path) else None
+            detail = describe_diff(expected_image, first) if expected_image is not None else 'no golden image'
+            failures.append('{:s}: {:s}'.format(name, detail))
+            save_failure(args.failure_dir, name, expected_image, first)
+        elif expected['sequence-frames'] == args.sequence_frames and expected['sequence'] != sequence_hash:
+            failures.append('{:s}: first frame matches, but the following {:d} frames differ'.format(
+                name, args.sequence_frames))
+    run_time = time.perf_counter() - pre_run
+
+    if args.action == 'record':
+        os.makedirs(args.golden_dir, exist_ok=True)
+        with open(golden_file, 'w') as outfil:
+            json.dump({'environment': environment, 'frames': recorded}, outfil, indent=1, sort_keys=True)
+        print('Recorded {:d} golden frames to {:s}'.format(len(recorded), golden_file))
+    for failure in failures:
+        print(failure)
+    print('{:d} frames in {:.2f}s, {:.1f} frames/s rendered and hashed'.format(
+        frames, run_time, frames / hash_time if hash_time > 0 else 0))
+    if len(failures) > 0:
+        print('{:d} cases failed, see {:s}'.format(len(failures), args.failure_dir))
+        if len(environment_changes) > 0:
+            print('The environment differs from the one the golden frames were recorded in, which may be why')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run_golden())
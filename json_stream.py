@@ -0,0 +1,149 @@
+import json
+import re
+
+whitespace_pat = re.compile(r'[ \t\n\r]*')
+# The rest of a string after its opening quote, up to and including the closing one
+string_body_pat = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# Everything up to the next bracket, strings included, so a value is skipped a bracket at a time rather than a token
+# at a time; it stops short at a quote whose string runs past the end of the buffer
+skip_pat = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*', re.DOTALL)
+scalar_end_pat = re.compile(r'[,\]}\s]')
+
+
+# Walks a JSON document a chunk at a time, so only the parts asked for are ever decoded; everything skipped is scanned
+# past without being built, and only the chunk being looked at is held in memory. Objects and arrays are walked with
+# iter_object and iter_array, and each value they reach has to be read or skipped before moving on
+class JSONStreamReader(object):
+    def __init__(self, fil, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = 64 * 1024
+        self.fil = fil
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        # Start of a value being read whole, which has to stay in the buffer until it's decoded
+        self.mark = None
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        start = self.pos if self.mark is None else self.mark
+        chunk = self.fil.read(self.chunk_size)
+        self.buf = self.buf[start:] + chunk
+        self.pos -= start
+        if self.mark is not None:
+            self.mark -= start
+        if chunk == '':
+            self.eof = True
+            return False
+        return True
+
+    def _error(self, message):
+        return ValueError('{:s} in JSON stream'.format(message))
+
+    def peek(self):
+        while True:
+            self.pos = whitespace_pat.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise self._error('Unexpected end')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self._error('Expected {:s}, found {:s}'.format(char, self.buf[self.pos]))
+        self.pos += 1
+
+    def _string_end(self):
+        while True:
+            mat = string_body_pat.match(self.buf, self.pos + 1)
+            if mat is not None:
+                return mat.end()
+            if not self._fill():
+                raise self._error('Unterminated string')
+
+    def _scalar_end(self):
+        while True:
+            mat = scalar_end_pat.search(self.buf, self.pos)
+            if mat is not None:
+                return mat.start()
+            if not self._fill():
+                return len(self.buf)
+
+    def read_string(self):
+        if self.peek() != '"':
+            raise self._error('Expected a string')
+        end = self._string_end()
+        value = json.decoder.scanstring(self.buf, self.pos + 1)[0]
+        self.pos = end
+        return value
+
+    def skip_value(self):
+        char = self.peek()
+        if char == '"':
+            self.pos = self._string_end()
+            return
+        if char not in '[{':
+            self.pos = self._scalar_end()
+            return
+        depth = 0
+        while True:
+            self.pos = skip_pat.match(self.buf, self.pos).end()
+            if self.pos == len(self.buf):
+                if not self._fill():
+                    raise self._error('Unexpected end')
+                continue
+            char = self.buf[self.pos]
+            if char == '"':
+                if not self._fill():
+                    raise self._error('Unterminated string')
+                continue
+            self.pos += 1
+            depth += 1 if char in '[{' else -1
+            if depth == 0:
+                return
+
+    # Decodes the next value in full; meant for small values
+    def read_value(self):
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            start = self.mark
+        finally:
+            self.mark = None
+        return self.decoder.raw_decode(self.buf, start)[0]
+
+    # Yields each key, leaving the reader at its value
+    def iter_object(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_string()
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise self._error('Expected , or }}, found {:s}'.format(char))
+
+    # Yields once for each element, leaving the reader at it
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise self._error('Expected , or ], found {:s}'.format(char))
@@ -0,0 +1,184 @@
+import memory_tools
+from PIL import Image
+
+# Stands in for the key of a layer that hasn't been drawn yet; never equal to anything a layer returns
+unset_key = object()
+
+
+# One part of a frame, drawn on its own and kept from frame to frame until it changes
+class Layer(object):
+    def __init__(self, position=None):
+        if position is None:
+            position = (0, 0)
+        self.position = position
+
+    # Identifies what the layer looks like this frame; None means it's different every frame
+    def get_key(self):
+        return None
+
+    # Brings the layer up to date; only called when its key has changed
+    def draw(self):
+        pass
+
+    # None hides the layer
+    def get_image(self):
+        return None
+
+    # Where the image is drawn; None draws all of it
+    def get_mask(self):
+        return None
+
+    def get_position(self):
+        return self.position
+
+    # Images the layer made for itself, rather than ones it borrows
+    def get_image_bytes(self):
+        return 0
+
+
+class ImageLayer(Layer):
+    def __init__(self, image, position=None, mask=None):
+        super().__init__(position=position)
+        self.image = image
+        self.mask = mask
+        self.version = 0
+
+    def set_image(self, image, mask=None):
+        self.image = image
+        self.mask = mask
+        self.version += 1
+
+    def get_key(self):
+        return self.version
+
+    def get_image(self):
+        return self.image
+
+    def get_mask(self):
+        return self.mask
+
+
+# A line of text in a box of its own, in the bottom right corner. `text_func` returns (text, color), or None to hide
+# it, and is asked every frame, so it should be cheap
+class BadgeLayer(Layer):
+    def __init__(self, image_size, font, height, text_func):
+        super().__init__()
+        self.image_size = image_size
+        self.font = font
+        self.height = height
+        self.text_func = text_func
+        self.badge = None
+        self.image = None
+
+    def get_key(self):
+        self.badge = self.text_func()
+        return ('badge', self.badge)
+
+    def draw(self):
+        if self.badge is None:
+            self.image = None
+            return
+        (text, color) = self.badge
+        bm_font = self.font.get_bm_font()
+        size = (bm_font.width(text) + 2, self.height)
+        text_mask = Image.new('L', size)
+        bm_font.text((1, 0), text_mask, text)
+        # The box is opaque, so the badge reads the same whatever is under it
+        self.image = Image.new('RGB', size)
+        self.image.paste(color, (0, 0, size[0], size[1]), text_mask)
+        self.position = (self.image_size[0] - size[0], self.image_size[1] - size[1])
+
+    def get_image(self):
+        return self.image
+
+    def get_image_bytes(self):
+        return 0 if self.image is None else memory_tools.image_bytes(self.image)
+
+
+# Draws a frame from layers, bottom first. Each layer's result is kept, with everything under it, so only the layers
+# from the lowest one that changed upwards are composited again; when nothing changed the last frame is handed back
+# as it is. The frame belongs to the stack, and is only good until the next compose
+class LayerStack(object):
+    def __init__(self, image_size, layers=None):
+        if layers is None:
+            layers = []
+        self.image_size = image_size
+        self.box = (0, 0, image_size[0], image_size[1])
+        self.layers = []
+        self.keys = []
+        self.buffers = []
+        self.composites = []
+        self.frame = None
+        self.composited = 0
+        for layer in layers:
+            self.add_layer(layer)
+
+    def add_layer(self, layer):
+        self.layers.append(layer)
+        self.keys.append(unset_key)
+        self.buffers.append(None)
+        self.composites.append(None)
+
+    def get_layers(self):
+        return self.layers
+
+    # Layers composited by the last compose
+    def get_composited(self):
+        return self.composited
+
+    def get_image_bytes(self):
+        images = [buffer for buffer in self.buffers if buffer is not None]
+        return memory_tools.count_image_bytes(images) + sum(layer.get_image_bytes() for layer in self.layers)
+
+    def get_buffer(self, idx):
+        if self.buffers[idx] is None:
+            self.buffers[idx] = Image.new('RGB', self.image_size)
+        return self.buffers[idx]
+
+    def composite_layer(self, idx, below):
+        layer = self.layers[idx]
+        image = layer.get_image()
+        mask = layer.get_mask()
+        position = layer.get_position()
+        if image is None:
+            if below is not None:
+                return below
+            buffer = self.get_buffer(idx)
+            buffer.paste((0, 0, 0), self.box)
+            return buffer
+        full_size = position == (0, 0) and image.size == self.image_size
+        if full_size and mask is None:
+            # Covers everything under it
+            return image
+        buffer = self.get_buffer(idx)
+        if below is None:
+            buffer.paste((0, 0, 0), self.box)
+        else:
+            buffer.paste(below)
+        if mask is None:
+            buffer.paste(image, position)
+        else:
+            buffer.paste(image, position, mask)
+        return buffer
+
+    def compose(self):
+        dirty_from = None
+        for idx, layer in enumerate(self.layers):
+            key = layer.get_key()
+            if key is None or key != self.keys[idx]:
+                layer.draw()
+                self.keys[idx] = key
+                if dirty_from is None:
+                    dirty_from = idx
+        self.composited = 0
+        if dirty_from is None and self.frame is not None:
+            return self.frame
+        if dirty_from is None:
+            dirty_from = 0
+        below = None if dirty_from == 0 else self.composites[dirty_from - 1]
+        for idx in range(dirty_from, len(self.layers)):
+            below = self.composite_layer(idx, below)
+            self.composites[idx] = below
+            self.composited += 1
+        self.frame = below
+        return self.frame
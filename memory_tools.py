@@ -0,0 +1,208 @@
+import json
+import os
+import time
+import tracemalloc
+from PIL import Image
+
+# Bytes per pixel Pillow actually holds for each mode; three channel images are padded out to four bytes
+image_mode_bytes = {
+    '1': 1,
+    'L': 1,
+    'P': 1,
+    'I;16': 2,
+    'LA': 4,
+    'PA': 4,
+    'La': 4,
+    'RGB': 4,
+    'RGBA': 4,
+    'RGBa': 4,
+    'RGBX': 4,
+    'CMYK': 4,
+    'YCbCr': 4,
+    'LAB': 4,
+    'HSV': 4,
+    'I': 4,
+    'F': 4,
+}
+palette_bytes = 1024  # Palette images carry a 256 entry RGBA palette along with them
+# Enough of each allocation's stack to see past Pillow and the standard library to the code that asked for it
+traceback_frames = 16
+
+
+def image_bytes(image):
+    (width, height) = image.size
+    size = width * height * image_mode_bytes.get(image.mode, 4)
+    if image.mode in ('P', 'PA'):
+        size += palette_bytes
+    return size
+
+
+def count_image_bytes(obj, seen=None):
+    # Adds up the images held directly or through dicts, lists, tuples and sets; each image is only counted once.
+    # Other objects aren't followed, so a cache can't accidentally count everything it has a reference to
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, Image.Image):
+        return image_bytes(obj)
+    if isinstance(obj, dict):
+        return sum(count_image_bytes(value, seen) for value in obj.values())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sum(count_image_bytes(value, seen) for value in obj)
+    return 0
+
+
+# Tracing has to start before the caches are built for their Python allocations to be seen at all
+def start_tracing():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(traceback_frames)
+
+
+class MemorySubsystem(object):
+    def __init__(self, name, measure_func, shrink_func=None, python_files=None):
+        if python_files is None:
+            python_files = []
+        self.name = name
+        # Returns the bytes of image data the subsystem holds
+        self.measure_func = measure_func
+        # Called with a number of bytes to get under; subsystems that can't give anything back don't have one
+        self.shrink_func = shrink_func
+        # Python allocations made from these files are put down to this subsystem
+        self.python_files = python_files
+        self.budget = None
+
+    def get_name(self):
+        return self.name
+
+    def get_budget(self):
+        return self.budget
+
+    def set_budget(self, budget):
+        self.budget = budget
+
+    def get_python_files(self):
+        return self.python_files
+
+    def measure(self):
+        return self.measure_func()
+
+    def can_shrink(self):
+        return self.shrink_func is not None
+
+    def shrink(self, max_bytes):
+        self.shrink_func(max_bytes)
+
+
+# Keeps track of what each cache and table is holding on to. Image buffers are counted exactly from their size and
+# mode; everything else comes from tracemalloc when tracing is on. An allocation is put down to the innermost file on
+# its stack that belongs to a subsystem, so what Pillow or the standard library allocates for a cache is charged to
+# the cache; anything else goes to the file that made it
+class MemoryAccounting(object):
+    def __init__(self, trace_python=None, time_func=None):
+        if trace_python is None:
+            trace_python = False
+        if time_func is None:
+            time_func = time.time
+        self.time_func = time_func
+        self.trace_python = trace_python
+        self.subsystems = {}
+        if self.trace_python:
+            start_tracing()
+
+    def add_subsystem(self, name, measure_func, shrink_func=None, python_files=None):
+        self.subsystems[name] = MemorySubsystem(name, measure_func, shrink_func=shrink_func, python_files=python_files)
+
+    def get_subsystem_names(self):
+        return list(self.subsystems.keys())
+
+    def set_budget(self, name, budget):
+        if name not in self.subsystems:
+            raise ValueError('Unknown memory subsystem {:s}, expected one of {:s}'.format(
+                name, ', '.join(self.subsystems.keys())))
+        if not self.subsystems[name].can_shrink():
+            raise ValueError('Memory subsystem {:s} can\'t be shrunk, so it can\'t have a budget'.format(name))
+        self.subsystems[name].set_budget(budget)
+
+    def has_budgets(self):
+        return any(subsystem.get_budget() is not None for subsystem in self.subsystems.values())
+
+    @staticmethod
+    def _python_bytes_by_file(charge_files):
+        by_file = {}
+        if not tracemalloc.is_tracing():
+            return by_file
+        for stat in tracemalloc.take_snapshot().statistics('traceback'):
+            # Tracebacks run from the oldest frame to the most recent
+            names = [os.path.basename(frame.filename) for frame in reversed(stat.traceback)]
+            if names[0] == 'tracemalloc.py':
+                continue  # Taking the snapshot itself
+            name = next((name for name in names if name in charge_files), names[0])
+            by_file[name] = by_file.get(name, 0) + stat.size
+        return by_file
+
+    def snapshot(self):
+        charge_files = set(fil for subsystem in self.subsystems.values() for fil in subsystem.get_python_files())
+        by_file = self._python_bytes_by_file(charge_files)
+        subsystems = {}
+        for name, subsystem in self.subsystems.items():
+            subsystems[name] = {
+                'image-bytes': subsystem.measure(),
+                'python-bytes': sum(by_file.get(fil, 0) for fil in subsystem.get_python_files()),
+                'budget': subsystem.get_budget(),
+            }
+        return {
+            'time': self.time_func(),
+            'subsystems': subsystems,
+            'python-total': sum(by_file.values()) if self.trace_python else None,
+            'python-by-file': by_file,
+        }
+
+    # Asks anything over its budget to shrink; returns (name, bytes before, bytes after) for each that was asked
+    def enforce_budgets(self):
+        shrunk = []
+        for name, subsystem in self.subsystems.items():
+            budget = subsystem.get_budget()
+            if budget is None or not subsystem.can_shrink():
+                continue
+            before = subsystem.measure()
+            if before <= budget:
+                continue
+            subsystem.shrink(budget)
+            shrunk.append((name, before, subsystem.measure()))
+        return shrunk
+
+
+def format_snapshot(snapshot, top_files=None):
+    if top_files is None:
+        top_files = 5
+    lines = []
+    for name, usage in snapshot['subsystems'].items():
+        budget = usage['budget']
+        lines.append('{:s}: images {:.1f}KiB python {:.1f}KiB{:s}'.format(
+            name, usage['image-bytes'] / 1024, usage['python-bytes'] / 1024,
+            '' if budget is None else ' budget {:.1f}KiB'.format(budget / 1024)))
+    if snapshot['python-total'] is not None:
+        lines.append('python total {:.1f}KiB'.format(snapshot['python-total'] / 1024))
+        by_size = sorted(snapshot['python-by-file'].items(), key=lambda item: item[1], reverse=True)
+        for fil, size in by_size[:top_files]:
+            lines.append('  {:s}: {:.1f}KiB'.format(fil, size / 1024))
+    return '\n'.join(lines)
+
+
+# One JSON object per line, so a benchmark run can be read back a snapshot at a time
+def append_snapshot(path, snapshot):
+    with open(path, 'a') as outfil:
+        outfil.write(json.dumps(snapshot, sort_keys=True) + '\n')
+
+
+def budget_from_string(string_in):
+    # SUBSYSTEM=KIB, e.g. text-cache=512
+    (name, sep, size) = string_in.partition('=')
+    try:
+        if sep == '':
+            raise ValueError(string_in)
+        return (name, int(float(size) * 1024))
+    except ValueError:
+        raise ValueError('Not a valid memory budget, expected SUBSYSTEM=KIB: {:s}'.format(string_in))
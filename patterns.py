@@ -1,7 +1,149 @@
+import effects
+import render_tools
+
+
 class DisplayPattern(object):
     def __init__(self, function_data, fonts):
         self.function_data = function_data
         self.fonts = fonts
+        # The font being drawn with, if the pattern draws text
+        self.font = None
+        self.scheduled_events = []
+        # Events that only run while the pattern is on screen, and, while it isn't, the time each one had left
+        self.active_events = []
+        self.paused_events = []
+        self.active = True
+        # Background effects, for patterns that use them; see create_effects
+        self.day_effect = None
+        self.night_effect = None
+        self.effect_names = {}
+        # The background is only advanced as often as the quality level allows; time builds up in between
+        self.background = None
+        self.background_effect = None
+        self.background_key = None
+        self.background_frames = 0
+        self.background_dt = 0
 
+    # The next frame, as an image the caller owns and can keep
     def frame(self, dt):
         pass
+
+    # Like frame, but the image can be one the pattern keeps drawing into, so it's only good until the next one. The
+    # buffers that saves allocating belong to the pattern (its layers, and the frame they're composited into), since
+    # only it knows which parts are still good from the last frame; the frame loop shows the image and lets it go
+    def render(self, dt):
+        return self.frame(dt)
+
+    def get_font(self):
+        return self.font
+
+    # `effect_factory` stands in for effects.create_effect, so patterns can be handed effects that are already built
+    def create_effects(self, day_effect, night_effect=None, effect_factory=None):
+        if night_effect is None:
+            night_effect = day_effect
+        if effect_factory is None:
+            effect_factory = effects.create_effect
+        size_data = self.function_data.get_size_data()
+        color_table = render_tools.gen_color_table(saturation=80)
+        self.day_effect = effect_factory(day_effect, size_data, color_table=color_table)
+        # Share the effect if it's the same, some of them hold a lot of precomputed images
+        if night_effect == day_effect:
+            self.night_effect = self.day_effect
+        else:
+            self.night_effect = effect_factory(night_effect, size_data, color_table=color_table)
+        self.effect_names = {day_effect: self.day_effect, night_effect: self.night_effect}
+
+    # The effects by name, so a new pattern of the same size can be given them rather than building its own
+    def get_effects(self):
+        return self.effect_names
+
+    # None if the pattern has no background effect
+    def get_effect(self):
+        if self.function_data.get_night_clock().is_night_hours():
+            return self.night_effect
+        return self.day_effect
+
+    def get_effect_bytes(self):
+        return sum(effect.get_image_bytes() for effect in set(self.effect_names.values()))
+
+    # Without `render` the effect only moves on, for patterns that draw it themselves (e.g. a box at a time), and
+    # background is left as None
+    def advance_background(self, effect, dt, quality, render=None):
+        if render is None:
+            render = True
+        background_fps = None if quality is None else quality.get_background_fps()
+        effect.set_color_step(1 if quality is None else quality.get_color_step())
+        self.background_dt += dt
+        if self.background_key is None or self.background_effect is not effect or background_fps is None \
+           or self.background_dt >= 1/background_fps:
+            if render:
+                self.background = effect.frame(self.background_dt)
+            else:
+                effect.advance(self.background_dt)
+                self.background = None
+            self.background_effect = effect
+            self.background_dt = 0
+            # Effects that repeat their frames say which one this is; the rest are new every time
+            frame_key = effect.get_frame_key()
+            self.background_frames += 1
+            self.background_key = ('frame', self.background_frames) if frame_key is None else (id(effect), frame_key)
+        return self.background
+
+    # Puts anything animated back to `rotation` (radians), so a given frame can be reproduced
+    def reset(self, rotation):
+        for effect in set(self.effect_names.values()):
+            effect.reset(rotation)
+        # Otherwise the next frame could carry on from a background made before the reset
+        self.background = None
+        self.background_key = None
+        self.background_dt = 0
+
+    # Patterns that aren't animated only change in response to timed events
+    def is_animated(self):
+        return True
+
+    # Timed events that belong to the pattern, so they stop along with it. Those `while_active` are held while the
+    # pattern is off screen, and pick up from where they were when it comes back
+    def schedule_periodic(self, period, callback, name=None, while_active=None):
+        if while_active is None:
+            while_active = False
+        if while_active and not self.active:
+            self.paused_events.append((period, callback, name, period))
+            return None
+        event = self.function_data.get_scheduler().schedule_periodic(period, callback, name=name)
+        self.scheduled_events.append(event)
+        if while_active:
+            self.active_events.append(event)
+        return event
+
+    def is_active(self):
+        return self.active
+
+    # Called when the pattern goes on or off screen
+    def set_active(self, active):
+        if active == self.active:
+            return
+        self.active = active
+        scheduler = self.function_data.get_scheduler()
+        if not active:
+            now = scheduler.get_time()
+            for event in self.active_events:
+                event.cancel()
+                self.scheduled_events.remove(event)
+                remaining = max(event.get_when() - now, 0)
+                self.paused_events.append((event.get_period(), event.callback, event.get_name(), remaining))
+            self.active_events = []
+            return
+        for (period, callback, name, remaining) in self.paused_events:
+            event = scheduler.schedule_periodic(period, callback, name=name, first_delay=remaining)
+            self.scheduled_events.append(event)
+            self.active_events.append(event)
+        self.paused_events = []
+
+    # Called once the pattern has been replaced and won't be drawn again
+    def close(self):
+        for event in self.scheduled_events:
+            event.cancel()
+        self.scheduled_events = []
+        self.active_events = []
+        self.paused_events = []
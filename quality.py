@@ -0,0 +1,134 @@
+import collections
+import json
+
+
+class QualityLevel(object):
+    def __init__(self, name, target_fps=None, background_fps=None, color_step=None, motion=None):
+        if target_fps is None:
+            target_fps = 60
+        if color_step is None:
+            color_step = 1
+        if motion is None:
+            motion = True
+        self.name = name
+        # Frames per second the loop aims for
+        self.target_fps = target_fps
+        # How often the background effect is advanced; None means every frame
+        self.background_fps = background_fps
+        # Background colors move in steps of this many degrees (or palette entries), rather than every one
+        self.color_step = color_step
+        # Whether text moves at all
+        self.motion = motion
+
+    def get_name(self):
+        return self.name
+
+    def get_target_fps(self):
+        return self.target_fps
+
+    def get_background_fps(self):
+        return self.background_fps
+
+    def get_color_step(self):
+        return self.color_step
+
+    def get_motion(self):
+        return self.motion
+
+    def serialize(self):
+        return {
+            'name': self.name,
+            'target-fps': self.target_fps,
+            'background-fps': self.background_fps,
+            'color-step': self.color_step,
+            'motion': self.motion
+        }
+
+    @classmethod
+    def deserialize(cls, json_obj):
+        return cls(
+            json_obj.get('name'),
+            target_fps=json_obj.get('target-fps'),
+            background_fps=json_obj.get('background-fps'),
+            color_step=json_obj.get('color-step'),
+            motion=json_obj.get('motion')
+        )
+
+
+# Best first; each step down is cheaper than the last
+default_levels = [
+    QualityLevel('full'),
+    QualityLevel('slow-background', background_fps=30, color_step=2),
+    QualityLevel('coarse', background_fps=15, color_step=6, motion=False),
+    QualityLevel('low-fps', target_fps=30, background_fps=10, color_step=12, motion=False),
+]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class QualityController(object):
+    def __init__(self, levels=None, window=None, degrade_load=None, recover_load=None, hold_time=None):
+        if levels is None:
+            levels = default_levels
+        if window is None:
+            window = 60  # Frames of render times we judge by
+        if degrade_load is None:
+            degrade_load = 0.9  # Step down once the slow frames use this much of the frame budget
+        if recover_load is None:
+            recover_load = 0.5  # Step back up once the slow frames would use less than this of the better budget
+        if hold_time is None:
+            hold_time = 5  # Seconds to stay on a level before changing again, so we don't flap between two
+        self.levels = levels
+        self.degrade_load = degrade_load
+        self.recover_load = recover_load
+        self.hold_time = hold_time
+        self.render_times = collections.deque(maxlen=window)
+        self.level_idx = 0
+        self.since_change = 0
+
+    def get_level(self):
+        return self.levels[self.level_idx]
+
+    def get_level_index(self):
+        return self.level_idx
+
+    def _change_level(self, level_idx):
+        self.level_idx = level_idx
+        self.render_times.clear()
+        self.since_change = 0
+
+    # Returns True if the level changed
+    def add_render_time(self, render_time, dt):
+        self.render_times.append(render_time)
+        self.since_change += dt
+        if len(self.render_times) < self.render_times.maxlen or self.since_change < self.hold_time:
+            return False
+        slow_frame = percentile(self.render_times, 0.9)
+        if slow_frame * self.get_level().get_target_fps() > self.degrade_load and self.level_idx < len(self.levels) - 1:
+            self._change_level(self.level_idx + 1)
+            return True
+        if self.level_idx > 0 and slow_frame * self.levels[self.level_idx - 1].get_target_fps() < self.recover_load:
+            self._change_level(self.level_idx - 1)
+            return True
+        return False
+
+    @classmethod
+    def deserialize(cls, json_obj):
+        levels = json_obj.get('levels')
+        if levels is not None:
+            levels = [QualityLevel.deserialize(level) for level in levels]
+        return cls(
+            levels=levels,
+            window=json_obj.get('window'),
+            degrade_load=json_obj.get('degrade-load'),
+            recover_load=json_obj.get('recover-load'),
+            hold_time=json_obj.get('hold-time')
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as infil:
+            return cls.deserialize(json.load(infil))
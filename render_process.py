@@ -0,0 +1,232 @@
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import signal
+import struct
+import time
+import fps_tools
+from PIL import Image
+
+# Header: magic, slot count, width, height, latest frame index (-1 for none), requested brightness (-1 for none)
+header_format = '<IIIIqq'
+header_size = struct.calcsize(header_format)
+ring_magic = 0x46524d52
+# Each slot has a sequence number; odd while a frame is being written to it, 2*(frame index+1) once it's complete
+slot_seq_format = '<q'
+slot_seq_size = struct.calcsize(slot_seq_format)
+
+
+class FrameRing(object):
+    def __init__(self, image_size, slots=None, name=None):
+        if slots is None:
+            slots = 3
+        self.image_size = image_size
+        self.slots = slots
+        self.frame_size = image_size[0] * image_size[1] * 3
+        self.frames_offset = header_size + slot_seq_size * slots
+        if name is None:
+            self.shm = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=self.frames_offset + self.frame_size * slots)
+            struct.pack_into(header_format, self.shm.buf, 0, ring_magic, slots, image_size[0], image_size[1], -1, -1)
+            for slot in range(slots):
+                struct.pack_into(slot_seq_format, self.shm.buf, header_size + slot_seq_size * slot, 0)
+        else:
+            self.shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        # If the writer is restarted it picks up numbering where the last one stopped
+        self.next_frame = self.get_latest_index() + 1
+
+    @classmethod
+    def attach(cls, name):
+        shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        (magic, slots, width, height, _, _) = struct.unpack_from(header_format, shm.buf, 0)
+        shm.close()
+        if magic != ring_magic:
+            raise ValueError('Shared memory {:s} is not a frame ring'.format(name))
+        return cls((width, height), slots=slots, name=name)
+
+    def get_name(self):
+        return self.shm.name
+
+    def get_image_size(self):
+        return self.image_size
+
+    def _get_header(self):
+        return struct.unpack_from(header_format, self.shm.buf, 0)
+
+    def _set_header(self, latest_index=None, brightness=None):
+        (magic, slots, width, height, old_latest, old_brightness) = self._get_header()
+        latest_index = old_latest if latest_index is None else latest_index
+        brightness = old_brightness if brightness is None else brightness
+        struct.pack_into(header_format, self.shm.buf, 0, magic, slots, width, height, latest_index, brightness)
+
+    def _get_slot_seq(self, slot):
+        return struct.unpack_from(slot_seq_format, self.shm.buf, header_size + slot_seq_size * slot)[0]
+
+    def _set_slot_seq(self, slot, seq):
+        struct.pack_into(slot_seq_format, self.shm.buf, header_size + slot_seq_size * slot, seq)
+
+    def get_latest_index(self):
+        return self._get_header()[4]
+
+    def get_brightness(self):
+        brightness = self._get_header()[5]
+        return None if brightness < 0 else brightness
+
+    def set_brightness(self, brightness):
+        self._set_header(brightness=brightness)
+
+    def write_frame(self, image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        index = self.next_frame
+        slot = index % self.slots
+        offset = self.frames_offset + slot * self.frame_size
+        self._set_slot_seq(slot, 2 * index + 1)
+        self.shm.buf[offset:offset + self.frame_size] = image.tobytes()
+        self._set_slot_seq(slot, 2 * index + 2)
+        self._set_header(latest_index=index)
+        self.next_frame += 1
+        return index
+
+    # Returns (frame index, frame bytes) for the newest complete frame, or None if there isn't a newer one
+    def read_latest(self, last_index=None, retries=None):
+        if retries is None:
+            retries = 3
+        for _ in range(retries):
+            index = self.get_latest_index()
+            if index < 0 or index == last_index:
+                return None
+            slot = index % self.slots
+            offset = self.frames_offset + slot * self.frame_size
+            seq_before = self._get_slot_seq(slot)
+            if seq_before != 2 * index + 2:
+                continue  # Already being overwritten by a newer frame; go get that one instead
+            data = bytes(self.shm.buf[offset:offset + self.frame_size])
+            if self._get_slot_seq(slot) == seq_before:
+                return index, data
+        return None
+
+    def read_latest_image(self, last_index=None):
+        latest = self.read_latest(last_index=last_index)
+        if latest is None:
+            return None
+        return latest[0], Image.frombytes('RGB', self.image_size, latest[1])
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# Stands in for the matrix in the render process, so brightness changes get passed on to the display process
+class BrightnessRelay(object):
+    def __init__(self, ring):
+        self.ring = ring
+
+    def get_brightness(self):
+        return self.ring.get_brightness()
+
+    def set_brightness(self, brightness):
+        self.ring.set_brightness(brightness)
+
+    brightness = property(get_brightness, set_brightness)
+
+
+def render_worker(ring_name, args, size_data):
+    import clock
+    ring = FrameRing.attach(ring_name)
+    parent = multiprocessing.parent_process()
+    renderer = clock.ClockRenderer(args, size_data, BrightnessRelay(ring))
+    while parent is None or parent.is_alive():
+        img = renderer.render_frame()
+        ring.write_frame(img)
+        sleep_time = renderer.finish_render()
+        if sleep_time > 0:
+            renderer.sleep(sleep_time)
+        renderer.finish_frame()
+    ring.close()
+
+
+class RenderProcessHost(object):
+    def __init__(self, args, size_data, slots=None):
+        self.args = args
+        self.size_data = size_data
+        self.ring = FrameRing(size_data.get_image_size(), slots=slots)
+        self.process = None
+        self.restart_requested = False
+        self.last_index = None
+        self.start()
+
+    def start(self):
+        self.process = multiprocessing.Process(target=render_worker, name='clock-render',
+                                               args=(self.ring.get_name(), self.args, self.size_data), daemon=True)
+        self.process.start()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    # Safe to call from a signal handler; the restart happens on the next check_worker
+    def request_restart(self):
+        self.restart_requested = True
+
+    def check_worker(self):
+        if self.restart_requested:
+            print('Restarting render process')
+            self.restart_requested = False
+            self.stop()
+            self.start()
+        elif not self.process.is_alive():
+            print('Render process exited with {:s}, restarting'.format(str(self.process.exitcode)))
+            self.start()
+
+    def get_latest_frame(self):
+        latest = self.ring.read_latest_image(last_index=self.last_index)
+        if latest is None:
+            return None
+        self.last_index = latest[0]
+        return latest[1]
+
+    def get_brightness(self):
+        return self.ring.get_brightness()
+
+    def close(self):
+        self.stop()
+        self.ring.close()
+        self.ring.unlink()
+
+
+def run_display(args, size_data, matrix, max_frames=None):
+    host = RenderProcessHost(args, size_data)
+    # SIGUSR1 restarts the renderer; the matrix keeps showing the last frame until the new one catches up
+    signal.signal(signal.SIGUSR1, lambda signum, frame: host.request_restart())
+    fps_clock = fps_tools.FPSClock(target_fps=60)
+    brightness = None
+    frames = 0
+    try:
+        while max_frames is None or frames < max_frames:
+            fps_clock.start_frame()
+            host.check_worker()
+            img = host.get_latest_frame()
+            if img is not None:
+                matrix.SetImage(img, 0, 0)
+            requested_brightness = host.get_brightness()
+            if requested_brightness is not None and requested_brightness != brightness:
+                brightness = requested_brightness
+                matrix.brightness = brightness
+
+            fps_clock.finish_render()
+            sleep_time = fps_clock.get_sleep_time()
+            if args.debug_fps:
+                print('Display frame time {:.3f} New frame {:s} Sleep Time {:.3f} (pid {:d})'.format(
+                    fps_clock.get_last_render_time(), str(img is not None), sleep_time, os.getpid()))
+            frames += 1
+            if args.debug_single and img is not None:
+                return
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            fps_clock.finish_frame()
+    finally:
+        host.close()
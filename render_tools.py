@@ -1,9 +1,86 @@
 from PIL import Image, ImageDraw, ImageFont, ImageColor
 import datetime
+import threading
+import memory_tools
 
 
 font_height_str = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-=!@#$%^&*()_+;:\'"[]{},.<>/?\\|`~ \t'
 
+# Debug aid: counts every Pillow image created on the render thread, by hooking the constructor nearly all
+# Pillow operations go through. Only installed on request, since it's a private Pillow method.
+class AllocationCounter(object):
+    def __init__(self):
+        self.thread_id = None
+        self.count = 0
+        self.frame_start = 0
+        self.last_frame = 0
+        self.original_new = None
+
+    def install(self):
+        if self.original_new is not None:
+            return
+        self.thread_id = threading.get_ident()
+        self.original_new = Image.Image._new
+        counter = self
+
+        def counting_new(image, im):
+            if threading.get_ident() == counter.thread_id:
+                counter.count += 1
+            return counter.original_new(image, im)
+        Image.Image._new = counting_new
+
+    def uninstall(self):
+        if self.original_new is None:
+            return
+        Image.Image._new = self.original_new
+        self.original_new = None
+
+    def start_frame(self):
+        self.frame_start = self.count
+
+    def finish_frame(self):
+        self.last_frame = self.count - self.frame_start
+        return self.last_frame
+
+    def get_last_frame(self):
+        return self.last_frame
+
+    def get_total(self):
+        return self.count
+
+
+allocations = AllocationCounter()
+
+
+class FontMetrics(object):
+    # Strings we've measured are remembered; the clock produces a new string every second, so this gets wiped now
+    # and again rather than growing forever
+    string_memo_limit = 4096
+
+    def __init__(self, font):
+        self.font = font
+        self.bboxes = {}
+
+    def get_bbox(self, string):
+        bbox = self.bboxes.get(string)
+        if bbox is None:
+            if len(self.bboxes) >= self.string_memo_limit:
+                self.bboxes.clear()
+            bbox = self.font.getbbox(string)
+            self.bboxes[string] = bbox
+        return bbox
+
+    def width(self, string):
+        bbox = self.get_bbox(string)
+        return bbox[2] - bbox[0]
+
+    # The same as the old FreeTypeFont.getsize: the width of the ink (so a glyph that hangs left of the origin, like
+    # a J, counts), and the height down from the ascender line
+    def get_size(self, string):
+        bbox = self.get_bbox(string)
+        return (bbox[2] - bbox[0], bbox[3])
+
+
 class TextImageCacheEntry(object):
     def __init__(self, bitmap, now_time, keepalive_time=None):
         self.bitmap = bitmap
@@ -26,11 +103,14 @@ class TextImageCacheEntry(object):
         return (self.last_use + self.keepalive_time) < time_now
 
 class TextImageCacheRenderer(object):
-    def __init__(self, font):
+    def __init__(self, font, metrics=None):
+        if metrics is None:
+            metrics = FontMetrics(font)
         self.font = font
+        self.metrics = metrics
 
     def get_image(self, string):
-        (width, height) = self.font.getsize(string)
+        (width, height) = self.metrics.get_size(string)
         img = Image.new('L', (width, height))
         draw = ImageDraw.Draw(img)
         draw.text((0, height), string, font=self.font, fill=255, anchor='lb')
@@ -45,11 +125,17 @@ class TextImageCache(object):
         self.renderer = renderer
         self.cache_check_time = self.time_func()
         self.cache_clear_time = datetime.timedelta(seconds=10)
+        # Running totals, for tracing
+        self.hits = 0
+        self.misses = 0
 
     def get_string(self, string, keepalive_time=None):
         now = self.time_func()
         if string not in self.cache or self.cache[string].is_expired(now):
+            self.misses += 1
             self.cache[string] = TextImageCacheEntry(self.renderer.get_image(string), now, keepalive_time=keepalive_time)
+        else:
+            self.hits += 1
         self._check_cache_expiration(now)
         return self.cache[string].get_bitmap(now)
 
@@ -64,6 +150,24 @@ class TextImageCache(object):
       for string in to_del:
         del self.cache[string]
 
+    def get_hits(self):
+        return self.hits
+
+    def get_misses(self):
+        return self.misses
+
+    def get_image_bytes(self):
+        return sum(memory_tools.image_bytes(entry.bitmap) for entry in self.cache.values())
+
+    # Throws out the least recently used strings until the cache is down to max_bytes
+    def shrink(self, max_bytes):
+        size = self.get_image_bytes()
+        for string, entry in sorted(self.cache.items(), key=lambda item: item[1].get_last_use()):
+            if size <= max_bytes:
+                break
+            size -= memory_tools.image_bytes(entry.bitmap)
+            del self.cache[string]
+
 class BitmapBackedFont(object):
     def __init__(self, name, font, bitmap_text_drawing):
         self.name = name
@@ -79,6 +183,12 @@ class BitmapBackedFont(object):
     def get_bm_font(self):
         return self.bitmap_text_drawing
 
+    # A copy that shares nothing that changes as it's drawn with, for a renderer that may run alongside this one's
+    # (e.g. after a watchdog restart). The font is opened again, FreeType faces can't be used from two threads at once
+    def clone(self):
+        font = ImageFont.truetype(self.font.path, self.font.size)
+        return BitmapBackedFont(self.name, font, self.bitmap_text_drawing.clone(font))
+
 class BitmapTextDrawing(object):
     def width(self, string):
         pass
@@ -86,6 +196,24 @@ class BitmapTextDrawing(object):
     def text(self, position, image, string):
         pass
 
+    # The (image, position) pastes text would make, in order, so the same text can be drawn a piece at a time
+    def get_pastes(self, position, string):
+        return []
+
+    def get_image_bytes(self):
+        return 0
+
+    def shrink(self, max_bytes):
+        pass
+
+    # Text cache (hits, misses) so far; drawing that doesn't cache has neither
+    def get_cache_counts(self):
+        return (0, 0)
+
+    # Drawing for `font` that shares nothing that changes; drawing that keeps no state can just be shared
+    def clone(self, font):
+        return self
+
 class CharacterCachedBitmapTextDrawing(BitmapTextDrawing):
     def __init__(self, font, font_map=None, fit_height=None):
         self.font = font
@@ -100,9 +228,10 @@ class CharacterCachedBitmapTextDrawing(BitmapTextDrawing):
         # Pre-populate the map with the expected contents
         # Could we make an object for this? Undoubtedly! But currently it's not worth the effort
         font_map = {char: {'width': 0, 'height': 0, 'img': None} for char in font_height_str}
-        self.real_height = font.getsize(font_height_str)[1]
+        metrics = FontMetrics(font)
+        self.real_height = metrics.get_size(font_height_str)[1]
         for char, char_attributes in font_map.items():
-            (width, height) = font.getsize(char)
+            (width, height) = metrics.get_size(char)
             img = Image.new('L', (width, self.real_height))
             draw = ImageDraw.Draw(img)
             draw.text((0, self.real_height), str(char), font=font, fill=255, anchor='lb')
@@ -148,31 +277,64 @@ class CharacterCachedBitmapTextDrawing(BitmapTextDrawing):
                 image.paste(bm_char['img'], (x_pos+position[0], position[1]))
                 x_pos += bm_char['width']
 
+    def get_pastes(self, position, string):
+        pastes = []
+        x_pos = 0
+        for char in string:
+            bm_char = self.__get_from_fontmap(char)
+            if bm_char is not None:
+                pastes.append((bm_char['img'], (x_pos+position[0], position[1])))
+                x_pos += bm_char['width']
+        return pastes
+
+    def get_image_bytes(self):
+        return memory_tools.count_image_bytes(self.font_map)
+
 class StringCachedBitmapTextDrawing(BitmapTextDrawing):
-    def __init__(self, font, cache_keepalive=None):
+    def __init__(self, font, cache_keepalive=None, time_func=None):
         self.font = font
-        self.text_cache = TextImageCache(TextImageCacheRenderer(self.font))
+        self.metrics = FontMetrics(self.font)
+        self.text_cache = TextImageCache(TextImageCacheRenderer(self.font, metrics=self.metrics), time_func=time_func)
         self.cache_keepalive = cache_keepalive
 
+    def get_metrics(self):
+        return self.metrics
+
+    def clone(self, font):
+        return StringCachedBitmapTextDrawing(font, cache_keepalive=self.cache_keepalive,
+                                             time_func=self.text_cache.time_func)
+
     def width(self, string):
-        return self.font.getsize(string)[0]
+        return self.metrics.width(string)
 
     def text(self, position, image, string):
         string_image = self.text_cache.get_string(string, keepalive_time=self.cache_keepalive)
         image.paste(string_image, (position[0], position[1]))
 
+    def get_pastes(self, position, string):
+        return [(self.text_cache.get_string(string, keepalive_time=self.cache_keepalive), (position[0], position[1]))]
+
+    def get_image_bytes(self):
+        return self.text_cache.get_image_bytes()
+
+    def get_cache_counts(self):
+        return (self.text_cache.get_hits(), self.text_cache.get_misses())
+
+    def shrink(self, max_bytes):
+        self.text_cache.shrink(max_bytes)
+
 
-def get_font_fit(font_name, fit_height, start_size=None):
+def get_font_fit(font_name, fit_height, start_size=None, time_func=None):
     if start_size is None:
         start_size = 32
 
     font = ImageFont.truetype(font_name, start_size)
-    font_size = font.getsize(font_height_str)
+    font_size = FontMetrics(font).get_size(font_height_str)
     while font_size[1] > fit_height:
         start_size -= 1
         font = ImageFont.truetype(font_name, start_size)
-        font_size = font.getsize(font_height_str)
-    bm_draw = StringCachedBitmapTextDrawing(font)
+        font_size = FontMetrics(font).get_size(font_height_str)
+    bm_draw = StringCachedBitmapTextDrawing(font, time_func=time_func)
     return BitmapBackedFont(font.getname()[0], font, bm_draw)
 
 
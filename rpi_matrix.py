@@ -20,6 +20,15 @@ class FakeMatrixSaving(FakeMatrix):
         image.save('debug.png')
 
 
+class FakeMatrixCapturing(FakeMatrix):
+    def __init__(self, capture_sink):
+        super().__init__()
+        self.capture_sink = capture_sink
+
+    def SetImage(self, image, x, y):
+        self.capture_sink.submit(image)
+
+
 def real_matrix(size_data):
     from rgbmatrix import RGBMatrix, RGBMatrixOptions
     options = RGBMatrixOptions()
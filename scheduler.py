@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class ScheduledEvent(object):
+    def __init__(self, when, callback, period=None, name=None):
+        self.when = when
+        self.callback = callback
+        self.period = period
+        self.name = name
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def get_when(self):
+        return self.when
+
+    def get_name(self):
+        return self.name
+
+    def get_period(self):
+        return self.period
+
+
+class EventScheduler(object):
+    def __init__(self, time_func=None, debug=None):
+        if time_func is None:
+            time_func = time.monotonic
+        if debug is None:
+            debug = False
+        self.time_func = time_func
+        self.debug = debug
+        # Heap of (when, sequence, event); the sequence keeps events due at the same time in submission order
+        self.heap = []
+        self.sequence = itertools.count()
+        # Events can be scheduled from worker threads (e.g. weather callbacks)
+        self.lock = threading.Lock()
+
+    def _push(self, event):
+        with self.lock:
+            heapq.heappush(self.heap, (event.get_when(), next(self.sequence), event))
+        return event
+
+    def get_time(self):
+        return self.time_func()
+
+    def schedule_at(self, when, callback, name=None):
+        return self._push(ScheduledEvent(when, callback, name=name))
+
+    def schedule_in(self, delay, callback, name=None):
+        return self.schedule_at(self.time_func() + delay, callback, name=name)
+
+    def schedule_periodic(self, period, callback, name=None, first_delay=None):
+        if first_delay is None:
+            first_delay = period
+        return self._push(ScheduledEvent(self.time_func() + first_delay, callback, period=period, name=name))
+
+    def _pop_due(self, now):
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][2].is_cancelled():
+                heapq.heappop(self.heap)
+            if len(self.heap) == 0 or self.heap[0][0] > now:
+                return None
+            return heapq.heappop(self.heap)[2]
+
+    # Runs every event that is due, returns how many ran
+    def run_due(self, now=None):
+        if now is None:
+            now = self.time_func()
+        ran = 0
+        event = self._pop_due(now)
+        while event is not None:
+            if self.debug:
+                print('Running event {:s}'.format(str(event.get_name())))
+            if event.get_period() is not None:
+                # Stay on the original cadence, unless we've fallen more than a period behind
+                event.when += event.get_period()
+                if event.when <= now:
+                    event.when = now + event.get_period()
+                self._push(event)
+            event.callback()
+            ran += 1
+            event = self._pop_due(now)
+        return ran
+
+    def get_next_due(self):
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][2].is_cancelled():
+                heapq.heappop(self.heap)
+            if len(self.heap) == 0:
+                return None
+            return self.heap[0][0]
+
+    def get_time_until_next(self, now=None):
+        next_due = self.get_next_due()
+        if next_due is None:
+            return None
+        if now is None:
+            now = self.time_func()
+        return max(next_due - now, 0)
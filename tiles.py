@@ -0,0 +1,79 @@
+import concurrent.futures
+from PIL import Image
+
+
+def gen_tile_boxes(size_data):
+    (module_width, module_height) = size_data.get_module_size()
+    boxes = []
+    for y in range(size_data.get_height()):
+        for x in range(size_data.get_width()):
+            boxes.append((x * module_width, y * module_height, (x + 1) * module_width, (y + 1) * module_height))
+    return boxes
+
+
+def boxes_overlap(first, second):
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+
+
+# Renders a frame one module at a time, on a pool of threads (Pillow drops the GIL for the heavy lifting), and only
+# renders again the modules whose inputs changed since the last frame. Frames alternate between two buffers, so the
+# one handed back isn't touched by the next render
+class TileCompositor(object):
+    def __init__(self, size_data, max_workers=None):
+        self.boxes = gen_tile_boxes(size_data)
+        self.tile_keys = [None] * len(self.boxes)
+        self.frames = [Image.new('RGB', size_data.get_image_size()), Image.new('RGB', size_data.get_image_size())]
+        self.frame = self.frames[0]
+        # Tiles rendered since each buffer was last drawn, which it's missing
+        self.stale_tiles = [set(), set()]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.rendered_tiles = 0
+
+    def get_boxes(self):
+        return self.boxes
+
+    # `render_tile(box)` returns the tile for a box, and is run on the pool, so it mustn't change anything shared.
+    # `tile_keys` identify what each tile shows, and should be cheap to work out; a None key is always rendered again
+    def render(self, render_tile, tile_keys=None):
+        if tile_keys is None:
+            tile_keys = [None] * len(self.boxes)
+        dirty = [idx for idx, key in enumerate(tile_keys) if key is None or key != self.tile_keys[idx]]
+
+        executor = self.executor
+        if len(dirty) == 1 or executor is None:
+            # Not worth the round trip through the pool, or there's no pool left
+            results = [(idx, render_tile(self.boxes[idx])) for idx in dirty]
+        else:
+            futures = [(idx, executor.submit(render_tile, self.boxes[idx])) for idx in dirty]
+            results = [(idx, future.result()) for (idx, future) in futures]
+
+        back = 1 if self.frame is self.frames[0] else 0
+        frame = self.frames[back]
+        # Catch the back buffer up on the tiles drawn into the other one last time
+        for idx in self.stale_tiles[back] - set(dirty):
+            box = self.boxes[idx]
+            frame.paste(self.frame.crop(box), box[:2])
+        for (idx, tile) in results:
+            frame.paste(tile, self.boxes[idx][:2])
+            self.tile_keys[idx] = tile_keys[idx]
+        self.stale_tiles[back] = set()
+        self.stale_tiles[1 - back] = set(dirty)
+        self.frame = frame
+        self.rendered_tiles = len(dirty)
+        return self.frame
+
+    def get_frames(self):
+        return self.frames
+
+    def get_tile_count(self):
+        return len(self.boxes)
+
+    def get_rendered_tiles(self):
+        return self.rendered_tiles
+
+    # Anything still drawing with the compositor afterwards (e.g. a stalled renderer that's been replaced) renders its
+    # tiles on its own thread
+    def shutdown(self):
+        executor = self.executor
+        self.executor = None
+        executor.shutdown(wait=False)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+import clock
+import config
+
+
+# Frames are a fixed 60th of a second apart in virtual time, so the effect moves every frame as it would on the
+# display, rather than the loop mostly timing cache hits between microsecond steps
+def run_renderer(size_data, tile_workers, effect, run_time):
+    args = clock.parse_args(['--debug-no-matrix', '--debug-action', 'clock', '--clock-effect', effect,
+                             '--tile-workers', str(tile_workers), '--sim-speed', '0', '--fixed-quality'])
+    renderer = clock.ClockRenderer(args, size_data, clock.rpi_matrix.FakeMatrix(), background_weather=False)
+    frames = 0
+    try:
+        pre_run = time.perf_counter()
+        while time.perf_counter() - pre_run < run_time:
+            renderer.render_frame()
+            renderer.finish_render()
+            renderer.sleep(1/60)
+            renderer.finish_frame()
+            frames += 1
+        return frames / (time.perf_counter() - pre_run)
+    finally:
+        renderer.close()
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=None, help='Modules across; defaults to config.json')
+    parser.add_argument('--height', type=int, default=None, help='Modules down; defaults to config.json')
+    parser.add_argument('--effect', default='rainbow', help='Clock background effect to render')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4], help='Tile worker counts to compare')
+    parser.add_argument('--time', type=float, default=10, help='Seconds to run each configuration for')
+    args = parser.parse_args()
+
+    size_data = clock.load_display_config(os.path.dirname(os.path.realpath(__file__)))
+    size_data = config.DisplayConfig(
+        width=args.width if args.width is not None else size_data.get_width(),
+        height=args.height if args.height is not None else size_data.get_height(),
+        module_size=size_data.get_module_size()
+    )
+    image_size = size_data.get_image_size()
+    for workers in args.workers:
+        print('Running {:d}x{:d} ({:d}x{:d}px) with {:d} tile workers'.format(
+            size_data.get_width(), size_data.get_height(), image_size[0], image_size[1], workers))
+        fps = run_renderer(size_data, workers, args.effect, args.time)
+        print('{:d}x{:d},{:d},{:.2f}'.format(size_data.get_width(), size_data.get_height(), workers, fps))
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,195 @@
+import datetime
+import threading
+import time
+import traceback
+from PIL import Image, ImageDraw, ImageFont
+
+
+def gen_fallback_frame(image_size, now):
+    # Just the time, white on black; uses none of the renderer's fonts or caches, since those may be what's stuck
+    img = Image.new('RGB', image_size)
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default()
+    text = now.strftime('%H:%M:%S')
+    (left, top, right, bottom) = draw.textbbox((0, 0), text, font=font)
+    draw.text(((image_size[0] - (right - left)) / 2 - left, (image_size[1] - (bottom - top)) / 2 - top), text,
+              font=font, fill=(255, 255, 255))
+    return img
+
+
+# Hands frames to the matrix for whichever render loop is current. Each restart starts a new generation; a stalled
+# loop that wakes up later finds its generation replaced and its frames are dropped
+class FramePresenter(object):
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.generation_frames = 0
+        self.first_frame_time = None
+
+    def new_generation(self):
+        with self.lock:
+            self.generation += 1
+            self.generation_frames = 0
+            self.first_frame_time = None
+            return self.generation
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    # Returns False once the generation has been replaced, and the loop should stop
+    def present(self, generation, image):
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.matrix.SetImage(image, 0, 0)
+            if self.generation_frames == 0:
+                self.first_frame_time = time.monotonic()
+            self.generation_frames += 1
+            return True
+
+    # Only shown until the current generation has produced a frame of its own
+    def present_fallback(self, image):
+        with self.lock:
+            if self.generation_frames == 0:
+                self.matrix.SetImage(image, 0, 0)
+
+    def get_generation_frames(self):
+        return self.generation_frames
+
+    def get_first_frame_time(self):
+        return self.first_frame_time
+
+
+# Runs the frame loop on a thread and watches the FPSClock heartbeats from the main thread. A loop that stops
+# beating (or dies) is abandoned and a new one started, taking over the old renderer's fonts, effect tables and
+# weather, while a fallback clock is shown
+class Watchdog(object):
+    check_period = 0.25
+    fallback_period = 1.0
+
+    def __init__(self, args, size_data, matrix, containing_dir=None, stall_time=None, startup_time=None,
+                 max_restarts=None):
+        if stall_time is None:
+            stall_time = args.watchdog_timeout
+        if startup_time is None:
+            startup_time = 60  # A cold start builds every font and effect table, so it gets much longer
+        if max_restarts is None:
+            max_restarts = 5  # In a row, without a frame in between; then we give up and exit
+        self.args = args
+        self.size_data = size_data
+        self.matrix = matrix
+        self.containing_dir = containing_dir
+        self.stall_time = stall_time
+        self.startup_time = startup_time
+        self.max_restarts = max_restarts
+        self.presenter = FramePresenter(matrix)
+        self.lock = threading.Lock()
+        self.renderer = None
+        self.thread = None
+        self.generation_start = None
+        self.crashed = False
+        self.finished = False
+        self.restart_time = None
+        self.last_fallback = None
+        self.failed_restarts = 0
+        self.restart_latencies = []
+
+    def get_restart_latencies(self):
+        return self.restart_latencies
+
+    def _render_thread(self, generation, warm_start):
+        import clock
+        try:
+            if warm_start is None:
+                renderer = clock.ClockRenderer(self.args, self.size_data, self.matrix,
+                                               containing_dir=self.containing_dir)
+            else:
+                renderer = clock.ClockRenderer(self.args, self.size_data, self.matrix,
+                                               containing_dir=self.containing_dir,
+                                               time_source=warm_start.get_time_source(), warm_start=warm_start)
+                warm_start.close()
+            with self.lock:
+                if not self.presenter.is_current(generation):
+                    renderer.close()
+                    return
+                self.renderer = renderer
+            stall_at = None
+            if self.args.debug_stall is not None and generation == 1:
+                stall_at = time.monotonic() + self.args.debug_stall
+
+            def show_frame(img):
+                if stall_at is not None and time.monotonic() > stall_at:
+                    print('Stalling the render loop')
+                    threading.Event().wait()
+                return self.presenter.present(generation, img)
+            clock.run_frames(self.args, renderer, show_frame)
+            if self.presenter.is_current(generation):
+                self.finished = True
+        except Exception:
+            if self.presenter.is_current(generation):
+                traceback.print_exc()
+                self.crashed = True
+
+    def start_generation(self, warm_start):
+        generation = self.presenter.new_generation()
+        self.generation_start = time.monotonic()
+        self.crashed = False
+        self.thread = threading.Thread(target=self._render_thread, args=(generation, warm_start),
+                                       name='render-{:d}'.format(generation), daemon=True)
+        self.thread.start()
+
+    def show_fallback(self, renderer):
+        now = renderer.get_time_source().now() if renderer is not None else datetime.datetime.now()
+        self.presenter.present_fallback(gen_fallback_frame(self.size_data.get_image_size(), now))
+        self.last_fallback = time.monotonic()
+
+    def restart(self, reason):
+        self.failed_restarts += 1
+        if self.failed_restarts > self.max_restarts:
+            raise RuntimeError('Render loop {:s}, and {:d} restarts haven\'t produced a frame'.format(
+                reason, self.max_restarts))
+        with self.lock:
+            # If the last warm restart didn't get anywhere, whatever it took over may be the problem
+            warm_start = self.renderer if self.failed_restarts == 1 else None
+            self.renderer = None
+        print('Render loop {:s}, restarting {:s}'.format(reason, 'warm' if warm_start is not None else 'cold'))
+        self.restart_time = time.monotonic()
+        if warm_start is not None:
+            self.size_data = warm_start.size_data
+        self.start_generation(warm_start)
+        self.show_fallback(warm_start)
+
+    def run(self):
+        self.start_generation(None)
+        while not self.finished:
+            time.sleep(self.check_period)
+            now = time.monotonic()
+            renderer = self.renderer
+            if renderer is None:
+                stalled_for = now - self.generation_start
+                stall_limit = self.startup_time if self.restart_time is None else self.stall_time + self.startup_time
+            else:
+                stalled_for = now - renderer.get_fps_clock().get_heartbeat()
+                stall_limit = self.stall_time
+            if self.finished:
+                break
+            if self.crashed:
+                self.restart('crashed')
+            elif not self.thread.is_alive():
+                self.restart('exited')
+            elif stalled_for > stall_limit:
+                self.restart('stalled for {:.1f}s'.format(stalled_for))
+            elif self.restart_time is not None:
+                if self.presenter.get_generation_frames() > 0:
+                    latency = self.presenter.get_first_frame_time() - self.restart_time
+                    self.restart_latencies.append(latency)
+                    print('Render loop restarted, first frame {:.3f}s after the restart'.format(latency))
+                    self.restart_time = None
+                    self.failed_restarts = 0
+                elif now - self.last_fallback >= self.fallback_period:
+                    self.show_fallback(renderer)
+        if len(self.restart_latencies) > 0:
+            print('{:d} render loop restarts, first frame after {:.3f}s on average, {:.3f}s at worst'.format(
+                len(self.restart_latencies), sum(self.restart_latencies) / len(self.restart_latencies),
+                max(self.restart_latencies)))
@@ -1,8 +1,17 @@
+import array
+import bisect
 import datetime
+import io
+import math
 import re
+import time
 import tzlocal
 import os
 import json
+import json_stream
+import urllib.error
+import urllib.parse
+import urllib.request
 from noaa_sdk import NOAA
 
 
@@ -24,26 +33,52 @@ class PredictionDataPoint(object):
         return 1.8 * self.value + 32
 
 
+# Times (as POSIX timestamps) and values are kept in flat arrays of doubles, rather than an object per point; a
+# value that's missing is kept as NaN and handed back as None
 class PredictionSeries(object):
-    def __init__(self, data_points=None):
+    def __init__(self, data_points=None, tz=None):
         if data_points is None:
             data_points = []
-        self.data_points = data_points
+        self.tz = tz
+        self.times = array.array('d')
+        self.values = array.array('d')
+        for dp in data_points:
+            self.add_data_point(dp)
+
+    def add_value(self, value, timestamp):
+        # Forecasts come in order, so this is nearly always an append
+        idx = bisect.bisect_right(self.times, timestamp)
+        self.times.insert(idx, timestamp)
+        self.values.insert(idx, math.nan if value is None else value)
 
     def add_data_point(self, dp):
-        self.data_points.append(dp)
-        self.data_points.sort(key=lambda d: d.get_time())
+        if self.tz is None:
+            self.tz = dp.get_time().tzinfo
+        self.add_value(dp.get_value(), dp.get_time().timestamp())
+
+    def get_count(self):
+        return len(self.times)
+
+    def __get_data_point(self, idx):
+        value = self.values[idx]
+        return PredictionDataPoint(None if math.isnan(value) else value,
+                                   datetime.datetime.fromtimestamp(self.times[idx], self.tz))
 
     def get_value_at(self, time):
-        sel_dp = self.data_points[0]
-        for dp in self.data_points:
-            if dp.get_time() > time:
-                break
-            sel_dp = dp
-        return sel_dp
+        idx = bisect.bisect_right(self.times, time.timestamp()) - 1
+        return self.__get_data_point(max(0, idx))
 
     def get_data_points(self):
-        return list(self.data_points)
+        return [self.__get_data_point(idx) for idx in range(len(self.times))]
+
+    def serialize(self):
+        return {
+            'values': [
+                {'validTime': datetime.datetime.fromtimestamp(timestamp, self.tz).isoformat(),
+                 'value': None if math.isnan(value) else value}
+                for (timestamp, value) in zip(self.times, self.values)
+            ]
+        }
 
 
 class WeatherPredictionData(object):
@@ -51,6 +86,8 @@ class WeatherPredictionData(object):
         r'(?P<timestamp>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2})(?P<timezone>[\+-][0-9]{2}:[0-9]{2})(/P.+)?')
 
     prediction_length = datetime.timedelta(hours=48)
+    # The only parts of the forecastGridData response we use, out of several dozen
+    series_keys = ('probabilityOfPrecipitation', 'temperature', 'relativeHumidity')
 
     # Extracts the timestamp from a duration, discarding the duration
     @classmethod
@@ -59,26 +96,24 @@ class WeatherPredictionData(object):
         if mat is None:
             return None
         time_str = mat.group('timestamp')
-        time_zone = mat.group('timezone').replace(':', '')
-        return datetime.datetime.strptime('{}{}'.format(time_str, time_zone), '%Y-%m-%dT%X%z').astimezone(tz)
+        time_zone = mat.group('timezone')
+        return datetime.datetime.fromisoformat(time_str + time_zone).astimezone(tz)
 
-    def __init__(self, weather_data, timezone):
-        now = datetime.datetime.now(timezone)
+    def __init__(self, weather_data, timezone, now=None):
+        if now is None:
+            now = datetime.datetime.now(timezone)
+        self.timezone = timezone
+        self.time_limit = now + self.prediction_length
+        self.series = {key: PredictionSeries(tz=timezone) for key in self.series_keys}
+        self.precipitation = self.series['probabilityOfPrecipitation']
+        self.temperature = self.series['temperature']
+        self.humidity = self.series['relativeHumidity']
         if weather_data is None:
             self.last_updated = now - self.prediction_length  # If we have no data, assume our prediction is old
-            self.precipitation = PredictionSeries()
-            self.temperature = PredictionSeries()
-            self.humidity = PredictionSeries()
             return
 
         self.last_updated = self.__duration_timestamp(weather_data['updateTime'], timezone)
-        temp_dict = {
-            'probabilityOfPrecipitation': PredictionSeries(),
-            'temperature': PredictionSeries(),
-            'relativeHumidity': PredictionSeries()
-        }
-        time_limit = now + self.prediction_length
-        for key, series in temp_dict.items():
+        for key, series in self.series.items():
             # weather_data[key] looks like
             # "temperature": { << Key
             #     "uom": "wmoUnit:degC",
@@ -92,19 +127,77 @@ class WeatherPredictionData(object):
             # For temp it's degrees C
             # For humidity + precipitation it's % (relative humidity and probability)
             for measure_value in weather_data[key]['values']:
-                ts = self.__duration_timestamp(measure_value['validTime'], timezone)
-                if ts > time_limit:
+                self.__add_value(series, measure_value['validTime'], measure_value['value'])
+
+    # False when the point is past the prediction window, and was left out
+    def __add_value(self, series, valid_time, value):
+        ts = self.__duration_timestamp(valid_time, self.timezone)
+        if ts > self.time_limit:
+            return False
+        series.add_value(value, ts.timestamp())
+        return True
+
+    # Builds the prediction straight from a forecastGridData response (or our cache of one) as it's read, skipping
+    # every series we don't use and every point past the prediction window without decoding them
+    @classmethod
+    def read(cls, fil, timezone, now=None):
+        prediction = cls(None, timezone, now=now)
+        update_time = prediction.__read_properties(json_stream.JSONStreamReader(fil))
+        if update_time is None:
+            raise ValueError('Forecast has no updateTime')
+        prediction.last_updated = cls.__duration_timestamp(update_time, timezone)
+        return prediction
+
+    def __read_properties(self, reader):
+        update_time = None
+        for key in reader.iter_object():
+            if key == 'properties':
+                # The API response wraps the forecast up as GeoJSON; the cache doesn't
+                update_time = self.__read_properties(reader)
+            elif key == 'updateTime':
+                update_time = reader.read_string()
+            elif key in self.series:
+                self.__read_series(reader, self.series[key])
+            else:
+                reader.skip_value()
+        return update_time
+
+    def __read_series(self, reader, series):
+        for key in reader.iter_object():
+            if key != 'values':
+                reader.skip_value()
+                continue
+            past_limit = False
+            for _ in reader.iter_array():
+                if past_limit:
+                    # Points come in time order, so the rest of the series is past the window too
+                    reader.skip_value()
                     continue
-                value = measure_value['value']
-                series.add_data_point(PredictionDataPoint(value, ts))
+                valid_time = None
+                value = None
+                for value_key in reader.iter_object():
+                    if value_key == 'validTime':
+                        valid_time = reader.read_string()
+                    elif value_key == 'value':
+                        value = reader.read_value()
+                    else:
+                        reader.skip_value()
+                if valid_time is not None:
+                    past_limit = not self.__add_value(series, valid_time, value)
 
-        self.precipitation = temp_dict['probabilityOfPrecipitation']
-        self.temperature = temp_dict['temperature']
-        self.humidity = temp_dict['relativeHumidity']
+    # Only what we use, in the same shape as the response, so it reads back the same way
+    def serialize(self):
+        data = {key: series.serialize() for key, series in self.series.items()}
+        data['updateTime'] = self.last_updated.replace(microsecond=0).isoformat()
+        return data
 
     def get_last_updated(self):
         return self.last_updated
 
+    # False for the stand in we use when a retrieval fails
+    def has_data(self):
+        return any(series.get_count() > 0 for series in self.series.values())
+
     def get_temp_data(self):
         return self.temperature
 
@@ -118,51 +211,106 @@ class WeatherPredictionData(object):
 class WeatherCache(object):
     cache_file = 'weather_cache.json'
     cache_length = datetime.timedelta(hours=23)
+    request_timeout = 30  # Seconds
+    # The service fails now and then with a 5xx that works on the next try; the first retry waits retry_delay seconds,
+    # and each one after twice as long as the last
+    request_retries = 3
+    retry_delay = 2
+    geocode_url = 'https://nominatim.openstreetmap.org/search'
 
-    def __init__(self, zip_code=None, country=None, tz=None):
+    def __init__(self, zip_code=None, country=None, tz=None, time_func=None, load_cached=None):
         if zip_code is None:
             zip_code = '27529'
         if country is None:
             country = 'US'
         if tz is None:
             tz = tzlocal.get_localzone()
+        if time_func is None:
+            time_func = self._local_now
+        if load_cached is None:
+            load_cached = True
+        # The cache file doesn't say where it's for, so it's skipped when the location has just changed
+        self.load_cached = load_cached
+        self.time_func = time_func
         self.zip_code = zip_code
         self.country = country
         self.tz = tz
-        self.weather_data = None
         self.weather_prediction_data = None
 
+    # Another cache for the same place, starting from what this one has; the prediction itself is never changed once
+    # it's built, so it can be shared
+    def clone(self):
+        weather_cache = WeatherCache(zip_code=self.zip_code, country=self.country, tz=self.tz,
+                                     time_func=self.time_func, load_cached=self.load_cached)
+        weather_cache.weather_prediction_data = self.weather_prediction_data
+        return weather_cache
+
     def get_current_prediction(self):
-        if self.weather_data is None:
-            if os.path.isfile(self.cache_file):
-                try:
-                    with open(self.cache_file, 'r') as infil:
-                        self.weather_data = json.load(infil)
-                        self.weather_prediction_data = WeatherPredictionData(self.weather_data, self.tz)
-                except Exception as e:
-                    print('Unable to load weather data from {:s}: {:s}'.format(os.path.abspath(self.cache_file), str(e)))
-        if self.weather_data is None or self._cache_too_old():
-            self.weather_data = self._retrieve_weather_immediate()
-            self.weather_prediction_data = WeatherPredictionData(self.weather_data, self.tz)
+        if self.weather_prediction_data is None and self.load_cached and os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as infil:
+                    self.weather_prediction_data = WeatherPredictionData.read(infil, self.tz, now=self.time_func())
+            except Exception as e:
+                print('Unable to load weather data from {:s}: {:s}'.format(os.path.abspath(self.cache_file), str(e)))
+        if self._cache_too_old():
+            self.weather_prediction_data = self._retrieve_weather_immediate()
+            if self.weather_prediction_data is None:
+                self.weather_prediction_data = WeatherPredictionData(None, self.tz, now=self.time_func())
+                return self.weather_prediction_data
             try:
                 with open(self.cache_file, 'w') as outfil:
-                    json.dump(self.weather_data, outfil)
+                    json.dump(self.weather_prediction_data.serialize(), outfil)
             except Exception as e:
                 print('Unable to cache weather data to {:s}: {:s}'.format(os.path.abspath(self.cache_file), str(e)))
         return self.weather_prediction_data
 
     def _retrieve_weather_immediate(self):
+        # The grid forecast runs to a few MB, nearly all of it series we don't use, so rather than have the SDK decode
+        # it all we look up the forecast's URL and stream it ourselves
         try:
             noaa = NOAA()
-            return noaa.get_forecasts(self.zip_code, self.country, type='forecastGridData')
+            headers = noaa.get_request_header()
+            (lat, lon) = self._lookup_lat_lon(headers)
+            points = noaa.points('{},{}'.format(lat, lon))
+            if 'properties' not in points:
+                raise Exception('"properties" attribute not found. Possible response json changes')
+            with self._open_request(points['properties']['forecastGridData'], headers) as response:
+                return WeatherPredictionData.read(io.TextIOWrapper(response, encoding='utf-8'), self.tz,
+                                                  now=self.time_func())
         except Exception as e:
             print('Couldn\'t retrieve weather data: {:s}'.format(str(e)))
             return None
 
+    def _open_request(self, url, headers):
+        request = urllib.request.Request(url, headers=headers)
+        retry = 0
+        while True:
+            try:
+                return urllib.request.urlopen(request, timeout=self.request_timeout)
+            except urllib.error.HTTPError as e:
+                if e.code < 500 or retry >= self.request_retries:
+                    raise
+                e.close()
+                print('Request to {:s} failed with code {:d}, retrying'.format(url, e.code))
+            time.sleep(self.retry_delay * 2 ** retry)
+            retry += 1
+
+    # The same postal code lookup the SDK does for its own forecast calls, against OpenStreetMap's Nominatim
+    def _lookup_lat_lon(self, headers):
+        query = urllib.parse.urlencode({'postalcode': self.zip_code, 'country': self.country, 'format': 'json'})
+        with self._open_request('{:s}?{:s}'.format(self.geocode_url, query), headers) as response:
+            places = json.load(io.TextIOWrapper(response, encoding='utf-8'))
+        if len(places) == 0 or 'lat' not in places[0] or 'lon' not in places[0]:
+            raise Exception('Postal code {} in {} not found'.format(self.zip_code, self.country))
+        return (float(places[0]['lat']), float(places[0]['lon']))
+
+    def _local_now(self):
+        return datetime.datetime.now(self.tz)
+
     def _cache_too_old(self):
         if self.weather_prediction_data is None:
             return True
-        local_now = datetime.datetime.now(self.tz)
+        local_now = self.time_func()
         return self.weather_prediction_data.get_last_updated() + self.cache_length < local_now
 
 
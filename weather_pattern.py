@@ -1,13 +1,19 @@
 import weather
 import render_tools
+import memory_tools
+import layers
 import patterns
 import datetime
 import concurrent.futures
-from PIL import Image, ImageDraw
+from PIL import Image
 
 
 class WeatherPattern(patterns.DisplayPattern):
     cache_duration = datetime.timedelta(minutes=30)
+    # How often we check whether the cached weather has gone stale, or a failed retrieval needs retrying
+    refresh_check_duration = datetime.timedelta(minutes=1)
+    # How long after a failed retrieval before we try again, rather than waiting out the whole cache_duration
+    retry_duration = datetime.timedelta(minutes=5)
     temp_thresholds = {
         37: (255, 50, 50),  # Very hot, almost exclusively red
         32: (255, 150, 100),  # Hot, red orange
@@ -17,9 +23,11 @@ class WeatherPattern(patterns.DisplayPattern):
         0:  (50, 100, 255),  # Freezing, very blue
     }
 
-    def __init__(self, function_data, fonts):
+    def __init__(self, function_data, fonts, weather_cache=None, background_fetch=None, day_effect=None,
+                 night_effect=None, effect_factory=None):
         super().__init__(function_data, fonts)
-        self.futureExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if background_fetch is None:
+            background_fetch = True
         min_width = self.function_data.get_size_data().get_image_size()[0]
         test_str = '100F'
         min_font_name = list(self.fonts.keys())[0]  # Pick a random one to make sure we have something
@@ -32,14 +40,38 @@ class WeatherPattern(patterns.DisplayPattern):
                 min_font_name = name
         if self.function_data.get_debug_flag('font'):
             print('Weather using {:s}'.format(min_font_name))
-        self.weather_cache = weather.WeatherCache(zip_code='27529', country='US')
+        if weather_cache is None:
+            weather_cache = weather.WeatherCache(zip_code='27529', country='US',
+                                                 time_func=self.function_data.get_time_source().now)
+        self.weather_cache = weather_cache
         self.cache_time = None
-        self.image_cache = self.__default_image()
-        self.__submit_weather_future()
+        # The last forecast retrieved, and how many times one has been; until the first, we show that we're waiting
+        self.forecast = None
+        self.forecast_version = 0
+        self.current_temperature = None
+        self.current_temperature_key = None
+        forecast_layer = WeatherForecastLayer(self)
+        self.layers = layers.LayerStack(self.function_data.get_size_data().get_image_size(), layers=[forecast_layer])
+        # Without an effect the legend is plain white, drawn along with the forecast
+        if day_effect is not None:
+            self.create_effects(day_effect, night_effect=night_effect, effect_factory=effect_factory)
+            self.layers.add_layer(WeatherLegendLayer(self, forecast_layer))
+        self.weather_data_future = None
+        # The retrieval the forecast came from
+        self.forecast_future = None
+        self.background_fetch = background_fetch
+        # Without a background fetch, whoever owns the loop retrieves the weather and hands it to update_weather
+        if background_fetch:
+            self.futureExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.__submit_weather_future()
+            self.schedule_periodic(
+                self.refresh_check_duration.total_seconds(), self.__refresh_weather, name='weather-refresh')
 
+    # Points the forecast has no value for (null in the response) are left out
     @staticmethod
     def __retrieve_limit_value(values, begin, end):
-        time_limited_values = [value for value in values if value.is_timely(begin, end)]
+        time_limited_values = [value for value in values
+                               if value.is_timely(begin, end) and value.get_value() is not None]
         return time_limited_values
 
     def __get_temp_colorcode(self, value):
@@ -54,15 +86,16 @@ class WeatherPattern(patterns.DisplayPattern):
                 break
         return sel_color
 
-    def __default_image(self):
+    def get_image_bytes(self):
+        return self.layers.get_image_bytes()
+
+    def __draw_retrieving(self, image, legend):
         bm_font = self.font.get_bm_font()
-        image_size = self.function_data.get_size_data().get_image_size()
+        image_size = image.size
         text = 'Retrieving'
         max_width = bm_font.width(text)
         draw_w = int(image_size[0]/2 - max_width/2)
-        bg = render_tools.gen_black_image(image_size)
-        bm_font.text((draw_w, 0), bg, text)
-        return bg
+        bm_font.text((draw_w, 0), legend, text)
 
     def __submit_weather_future(self):
         self.weather_data_future = self.futureExecutor.submit(self.weather_cache.get_current_prediction)
@@ -77,15 +110,97 @@ class WeatherPattern(patterns.DisplayPattern):
     def __gen_image(self, future, wait=None):
         if wait is None:
             wait = False
+        # Each retrieval is only handed over once, however many times we're asked (e.g. every frame with --debug-single)
+        if future is self.forecast_future:
+            return
         now = self.function_data.get_now()
         weather_data = None
         try:
             wait_time = None if wait else 0.1
             weather_data = future.result(wait_time)
-            self.cache_time = now
+            self.__set_cache_time(now, weather_data)
+            self.forecast_future = future
         except concurrent.futures.TimeoutError:
             print('Timed out waiting for weather data')
+        self.__set_forecast(weather_data)
+
+    def get_weather_cache(self):
+        return self.weather_cache
+
+    # For a new location; the old forecast is thrown away and the new one fetched as soon as it can be
+    def set_weather_cache(self, weather_cache):
+        self.weather_cache = weather_cache
+        self.cache_time = None
+        if self.background_fetch:
+            self.__submit_weather_future()
+
+    def close(self):
+        super().close()
+        if self.background_fetch:
+            self.futureExecutor.shutdown(wait=False)
+
+    def needs_refresh(self):
+        now = self.function_data.get_now()
+        if now is None:
+            return False
+        return self.cache_time is None or self.cache_time < now-self.cache_duration
+
+    def update_weather(self, weather_data):
+        self.__set_cache_time(self.function_data.get_now(), weather_data)
+        self.__set_forecast(weather_data)
+
+    # A retrieval that failed, or came back with nothing in it, is retried after retry_duration
+    def __set_cache_time(self, now, weather_data):
+        if now is not None and (weather_data is None or not weather_data.has_data()):
+            self.cache_time = now - self.cache_duration + self.retry_duration
+        else:
+            self.cache_time = now
+
+    # Only records the forecast, which may be on the fetch thread; it's drawn when the next frame needs it
+    def __set_forecast(self, weather_data):
+        self.forecast = weather_data
+        self.forecast_version += 1
+
+    def get_forecast_version(self):
+        return self.forecast_version
+
+    # The temperature now, as (text, color) for a badge, or None without a forecast; worked out once an hour
+    def get_current_temperature(self):
+        now = self.function_data.get_now()
+        if now is None or self.forecast is None:
+            return None
+        key = (self.forecast_version, now.replace(minute=0, second=0, microsecond=0))
+        if key != self.current_temperature_key:
+            self.current_temperature_key = key
+            temp_data = self.forecast.get_temp_data()
+            self.current_temperature = None
+            if temp_data.get_count() > 0:
+                value = temp_data.get_value_at(now)
+                # Nothing to show for an hour the forecast has no temperature for
+                if value.get_value() is not None:
+                    self.current_temperature = ('{:.0f}F'.format(value.get_value_f()),
+                                                self.__get_temp_colorcode(value))
+        return self.current_temperature
 
+    def create_temperature_badge(self):
+        size_data = self.function_data.get_size_data()
+        return layers.BadgeLayer(size_data.get_image_size(), self.font, size_data.get_height()*16,
+                                 self.get_current_temperature)
+
+    # The legend ('Hi:', 'Lo:' and 'Retrieving') goes into `legend_mask` when there's one, to be filled with the effect
+    def draw_forecast(self, image, text_mask, legend_mask=None):
+        image_size = image.size
+        full_box = (0, 0, image_size[0], image_size[1])
+        image.paste((0, 0, 0), full_box)
+        legend = image
+        if legend_mask is not None:
+            legend_mask.paste(0, full_box)
+            legend = legend_mask
+        if self.forecast_version == 0:
+            self.__draw_retrieving(image, legend)
+            return
+        weather_data = self.forecast
+        now = self.function_data.get_now()
         max_fmt = '--F'
         min_fmt = '--F'
         bm_font = self.font.get_bm_font()
@@ -107,8 +222,6 @@ class WeatherPattern(patterns.DisplayPattern):
                 tm = lookahead_min.get_time()
                 min_fmt = '{:.0f}F {:s}'.format(lookahead_min.get_value_f(), self.__fmt_time(tm))
 
-        image_size = self.function_data.get_size_data().get_image_size()
-        bg = render_tools.gen_black_image(image_size)
         hi_legend_text = 'Hi:'
         hi_legend_width = bm_font.width(hi_legend_text)
         lo_legend_text = 'Lo:'
@@ -118,31 +231,86 @@ class WeatherPattern(patterns.DisplayPattern):
         max_width = max_legend_width + 1 + max(bm_font.width(max_fmt), bm_font.width(min_fmt))
         draw_w = int(image_size[0]/2 - max_width/2)
 
-        hi_img = Image.new('RGB', image_size)
-        hi_al = Image.new('L', image_size)
-        hi_draw = ImageDraw.Draw(hi_img)
-        bm_font.text((draw_w, 0), bg, hi_legend_text)
-        bm_font.text((draw_w+max_legend_width+1, 0), hi_al, max_fmt)
-        hi_draw.rectangle(((0, 0), image_size), fill=self.__get_temp_colorcode(lookahead_max))
-        bg = Image.composite(hi_img, bg, hi_al).convert("RGB")
+        # One mask, reused for each line; the colors are pasted straight through it rather than from solid images
+        text_mask.paste(0, full_box)
+        bm_font.text((draw_w, 0), legend, hi_legend_text)
+        bm_font.text((draw_w+max_legend_width+1, 0), text_mask, max_fmt)
+        image.paste(self.__get_temp_colorcode(lookahead_max), full_box, text_mask)
 
-        lo_img = Image.new('RGB', image_size)
-        lo_al = Image.new('L', image_size)
-        lo_draw = ImageDraw.Draw(lo_img)
-        bm_font.text((draw_w, int(image_size[1]/2)), bg, lo_legend_text)
-        bm_font.text((draw_w+max_legend_width+1, int(image_size[1]/2)), lo_al, min_fmt)
-        lo_draw.rectangle(((0, 0), image_size), fill=self.__get_temp_colorcode(lookahead_min))
-        bg = Image.composite(lo_img, bg, lo_al).convert("RGB")
+        text_mask.paste(0, full_box)
+        bm_font.text((draw_w, int(image_size[1]/2)), legend, lo_legend_text)
+        bm_font.text((draw_w+max_legend_width+1, int(image_size[1]/2)), text_mask, min_fmt)
+        image.paste(self.__get_temp_colorcode(lookahead_min), full_box, text_mask)
 
-        self.image_cache = bg
+    def __refresh_weather(self):
+        if self.needs_refresh() and (self.weather_data_future is None or self.weather_data_future.done()):
+            self.__submit_weather_future()
+
+    def is_animated(self):
+        return self.day_effect is not None
 
     def frame(self, dt):
+        # The layers draw into buffers of their own, and keep the frame for the next one
+        return self.render(dt).copy()
+
+    def render(self, dt):
         now = self.function_data.get_now()
         if now is None:
             return render_tools.gen_black_image(self.function_data.get_size_data().get_image_size())
-        if (self.cache_time is None or self.cache_time < now-self.cache_duration) \
-           and (self.weather_data_future is None or self.weather_data_future.done()):
-            self.__submit_weather_future()
         if self.function_data.get_debug_flag('single') and self.weather_data_future is not None:
             self.__gen_image(self.weather_data_future, wait=True)
-        return self.image_cache
+        if self.day_effect is not None:
+            self.advance_background(self.get_effect(), dt, self.function_data.get_quality())
+        return self.layers.compose()
+
+
+# The day's high and low, drawn again only when a new forecast comes in
+class WeatherForecastLayer(layers.Layer):
+    def __init__(self, pattern):
+        super().__init__()
+        self.pattern = pattern
+        image_size = pattern.function_data.get_size_data().get_image_size()
+        self.image = Image.new('RGB', image_size)
+        self.text_mask = Image.new('L', image_size)
+        self.legend_mask = None
+
+    def get_key(self):
+        return self.pattern.get_forecast_version()
+
+    def draw(self):
+        legend_mask = None
+        if self.pattern.day_effect is not None:
+            if self.legend_mask is None:
+                self.legend_mask = Image.new('L', self.image.size)
+            legend_mask = self.legend_mask
+        self.pattern.draw_forecast(self.image, self.text_mask, legend_mask=legend_mask)
+
+    def get_legend_mask(self):
+        return self.legend_mask
+
+    def get_image(self):
+        return self.image
+
+    def get_image_bytes(self):
+        images = [self.image, self.text_mask]
+        if self.legend_mask is not None:
+            images.append(self.legend_mask)
+        return memory_tools.count_image_bytes(images)
+
+
+# The legend filled with the pattern's effect; it sits on the forecast layer, so it's composited again whenever the
+# forecast is redrawn
+class WeatherLegendLayer(layers.Layer):
+    def __init__(self, pattern, forecast_layer):
+        super().__init__()
+        self.pattern = pattern
+        self.forecast_layer = forecast_layer
+
+    def get_key(self):
+        return self.pattern.background_key
+
+    def get_image(self):
+        return self.pattern.background
+
+    def get_mask(self):
+        return self.forecast_layer.get_legend_mask()